@@ -20,13 +20,16 @@ from collections import defaultdict
 from flex.conf import config
 from flex.core import signals
 from .backends.base import (
-	BaseCache, CacheKeyWarning, InvalidCacheBackendError,
+	BaseCache, CacheKeyWarning, InvalidCacheBackendError, DEFAULT_TIMEOUT,
+	AsyncCache,
 )
+from .memoize import memoize
+from .instrumentation import InstrumentedCache
 from flex.utils.module_loading import import_string
 
 __all__ = [
 	'cache', 'DEFAULT_CACHE_ALIAS', 'InvalidCacheBackendError',
-	'CacheKeyWarning', 'BaseCache',
+	'CacheKeyWarning', 'BaseCache', 'AsyncCache',
 ]
 
 
@@ -50,6 +53,7 @@ class _AppCacheContainer(object):
 			return rv
 
 	def create_cache(self, backend, **kwargs):
+		alias = backend
 		try:
 			# Try to get the CACHES entry for the given backend name first
 			try:
@@ -72,7 +76,12 @@ class _AppCacheContainer(object):
 		except ImportError as e:
 			raise InvalidCacheBackendError(
 				"Could not find backend '%s': %s" % (backend, e))
-		return backend_cls(location, params)
+
+		instrument = params.pop('instrument', None)
+		rv = backend_cls(location, params)
+		if instrument:
+			rv = InstrumentedCache(rv, alias, **(instrument if isinstance(instrument, dict) else {}))
+		return rv
 
 	def all(self):
 		return self.caches.values()
@@ -126,6 +135,18 @@ class CacheManager(object):
 		app = self._get_app(app)
 		return app.extensions['cache'].get_cache(alias)
 
+	def async_backend(self, alias=DEFAULT_CACHE_ALIAS, app=None):
+		"""Return the `alias` cache wrapped in an :class:`AsyncCache`, whose
+		methods are awaitable versions of the backend's.
+		"""
+		return AsyncCache(self.backend(alias, app))
+
+	def memoize(self, timeout=DEFAULT_TIMEOUT, alias=DEFAULT_CACHE_ALIAS, version=None):
+		"""Decorator that caches the results of the decorated function in the
+		`alias` cache. See :func:`flex.cache.memoize.memoize`.
+		"""
+		return memoize(self, timeout=timeout, alias=alias, version=version)
+
 	def __getitem__(self, alias):
 		return self.backend(alias)
 
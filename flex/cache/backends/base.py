@@ -1,11 +1,20 @@
 "Base Cache class."
 
+import math
 import time
+import random
+import asyncio
+import hashlib
 import warnings
+from uuid import uuid4
+from threading import Lock
+from functools import partial
 from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
 
 from flex.core.exc import ImproperlyConfigured
 from flex.utils.module_loading import import_string
+from ..serializers import get_serializer
 
 
 class InvalidCacheBackendError(ImproperlyConfigured):
@@ -23,6 +32,23 @@ DEFAULT_TIMEOUT = object()
 # Memcached does not accept keys longer than this.
 MEMCACHE_MAX_KEY_LENGTH = 250
 
+# Marks values stored by get_or_set() with stampede protection. Such values
+# are stored as (STAMPEDE_MARKER, value, compute_duration, soft_expiry).
+STAMPEDE_MARKER = '__flex_stampede__'
+
+STAMPEDE_MODES = ('lock', 'early')
+
+# Prefix of the keys holding the current generation of each cache tag.
+TAG_KEY_PREFIX = '__tag__:'
+
+
+class TagsFingerprint(str):
+	"""The fingerprint of the current generations of a set of cache tags as
+	returned by :meth:`BaseCache.get_tags_fingerprint`. Can be passed as the
+	`tags` argument of cache methods to avoid looking up the generations again.
+	"""
+	__slots__ = ()
+
 
 def default_key_func(key, prefix=None, version=None, reverse=False):
 	"""Default function to generate keys.
@@ -76,14 +102,21 @@ class BaseCache(object):
 		except (ValueError, TypeError):
 			self._cull_frequency = 3
 
-		self._serializer = params.get('serializer', 'pickle')
-		if self._serializer and isinstance(self._serializer, str):
-			self._serializer = import_string(self._serializer)
+		self._serializer = get_serializer(
+					params.get('serializer', 'pickle'),
+					compressor=params.get('compressor'),
+					min_size=params.get('compress_min_size', 1024),
+					level=params.get('compress_level'),
+				)
 
 		self.key_prefix = params.get('key_prefix')
 		self.version = params.get('version', 1)
 		self.key_func = self.get_key_func(params.get('key_function'))
 
+		self._async_max_workers = int(params.get('async_max_workers', 4))
+		self._async_executor = None
+		self._async_executor_lock = Lock()
+
 	def get_key_func(self, func):
 		return get_key_func(func)
 
@@ -99,13 +132,17 @@ class BaseCache(object):
 			return -1
 		return int(timeout)
 
-	def make_key(self, key, version=None, reverse=False):
+	def make_key(self, key, version=None, reverse=False, tags=None):
 		"""Constructs the key used by all other methods. By default it
 		uses the key_func to generate a key (which, by default,
 		prepends the `key_prefix' and 'version'). A different key
 		function can be provided at the time of cache construction;
 		alternatively, you can subclass the cache backend to provide
 		custom key making behavior.
+
+		If `tags` are given, the fingerprint of the tags' current generations
+		is appended to the key. Invalidating any of the tags changes the
+		fingerprint and thus the key, leaving the old value to expire.
 		"""
 		if reverse:
 			return self.key_func(key, self.key_prefix, reverse=True)
@@ -113,15 +150,53 @@ class BaseCache(object):
 		if version is None:
 			version = self.version
 
+		if tags:
+			key = '%s:%s' % (key, self.get_tags_fingerprint(tags))
+
 		return self.key_func(key, self.key_prefix, version=version)
 
+	def get_tags_fingerprint(self, tags):
+		"""Return the fingerprint of the current generations of the given tags.
+		Tags without a generation (never invalidated or evicted) are assigned
+		a new one.
+		"""
+		if isinstance(tags, TagsFingerprint):
+			return tags
+		elif isinstance(tags, str):
+			tags = (tags,)
+
+		tags = sorted(set(tags))
+		tag_keys = [TAG_KEY_PREFIX + str(t) for t in tags]
+		generations = self.get_many(tag_keys)
+		for tk in tag_keys:
+			if tk not in generations:
+				gen = self._new_tag_generation()
+				if not self.add(tk, gen, timeout=None):
+					gen = self.get(tk, gen)
+				generations[tk] = gen
+
+		rv = ';'.join('%s=%s' % (tk, generations[tk]) for tk in tag_keys)
+		return TagsFingerprint(hashlib.md5(rv.encode('utf-8')).hexdigest())
+
+	def invalidate_tags(self, *tags):
+		"""Invalidate all keys set with any of the given tags. This doesn't
+		touch the keys themselves. It only moves each tag to a new generation
+		so the old keys are no longer reachable and expire on their own.
+		"""
+		self.set_many({TAG_KEY_PREFIX + str(t): self._new_tag_generation() for t in tags}, timeout=None)
+
+	def _new_tag_generation(self):
+		# A random token rather than a counter so that a generation that was
+		# evicted is never reused.
+		return uuid4().hex[:16]
+
 	def encode(self, value):
 		return value if not self._serializer else self._serializer.dumps(value)
 
 	def decode(self, value):
 		return value if not self._serializer else self._serializer.loads(value)
 
-	def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+	def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None, tags=None):
 		"""
 		Set a value in the cache if the key does not already exist. If
 		timeout is given, that timeout will be used for the key; otherwise
@@ -131,27 +206,31 @@ class BaseCache(object):
 		"""
 		raise NotImplementedError('subclasses of BaseCache must provide an add() method')
 
-	def get(self, key, default=None, version=None):
+	def get(self, key, default=None, version=None, tags=None):
 		"""
 		Fetch a given key from the cache. If the key does not exist, return
 		default, which itself defaults to None.
 		"""
 		raise NotImplementedError('subclasses of BaseCache must provide a get() method')
 
-	def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+	def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None, tags=None):
 		"""
 		Set a value in the cache. If timeout is given, that timeout will be
 		used for the key; otherwise the default cache timeout will be used.
+
+		If tags are given, the key is bound to them and can be invalidated
+		with :meth:`invalidate_tags`. The same tags must then be passed when
+		reading or deleting the key.
 		"""
 		raise NotImplementedError('subclasses of BaseCache must provide a set() method')
 
-	def delete(self, key, version=None):
+	def delete(self, key, version=None, tags=None):
 		"""
 		Delete a key from the cache, failing silently.
 		"""
 		raise NotImplementedError('subclasses of BaseCache must provide a delete() method')
 
-	def get_many(self, keys, version=None):
+	def get_many(self, keys, version=None, tags=None):
 		"""
 		Fetch a bunch of keys from the cache. For certain backends (memcached,
 		pgsql) this can be *much* faster when fetching multiple values.
@@ -159,22 +238,57 @@ class BaseCache(object):
 		Returns a dict mapping each key in keys to its value. If the given
 		key is missing, it will be missing from the response dict.
 		"""
+		tags = tags and self.get_tags_fingerprint(tags)
 		d = {}
 		for k in keys:
-			val = self.get(k, version=version)
+			val = self.get(k, version=version, tags=tags)
 			if val is not None:
 				d[k] = val
 		return d
 
-	def get_or_set(self, key, default, timeout=DEFAULT_TIMEOUT, version=None):
+	def get_or_set(self, key, default, timeout=DEFAULT_TIMEOUT, version=None, tags=None,
+					stampede=None, beta=1.0, lock_timeout=30, blocking_timeout=5, grace=None):
 		"""
 		Fetch a given key from the cache. If the key does not exist,
 		the key is added and set to the default value. The default value can
 		also be any callable. If timeout is given, that timeout will be used
 		for the key; otherwise the default cache timeout will be used.
 
+		The `stampede` argument enables cache stampede protection for callable
+		defaults:
+
+		- `'lock'`: only the caller holding the key's `lock()` recomputes the
+		  value. The value is kept for `grace` (defaults to `lock_timeout`)
+		  seconds after it expires so that other callers get the stale value
+		  while it's recomputed. If there's no stale value, they wait for up
+		  to `blocking_timeout` seconds for the value to be computed.
+		- `'early'`: probabilistic early expiration (XFetch). Each caller
+		  may recompute the value before it expires with a probability that
+		  grows as the expiry nears, weighted by how long the last computation
+		  took and by `beta` (> 1.0 favors earlier recomputation).
+
+		Values stored with stampede protection carry some metadata and should
+		always be read through get_or_set() with the same `stampede` mode.
+
 		Return the value of the key stored or retrieved.
 		"""
+		if tags:
+			# Fold the tags into the key once for all the calls below.
+			key, tags = '%s:%s' % (key, self.get_tags_fingerprint(tags)), None
+
+		if stampede is not None:
+			if stampede not in STAMPEDE_MODES:
+				raise ValueError(
+					'Invalid stampede mode %r. Expected one of %s.'
+					% (stampede, ', '.join(STAMPEDE_MODES))
+				)
+			elif stampede == 'lock':
+				grace = lock_timeout if grace is None else grace
+				return self._get_or_set_locked(key, default, timeout, version,
+									lock_timeout, blocking_timeout, grace)
+			else:
+				return self._get_or_set_early(key, default, timeout, version, beta)
+
 		val = self.get(key, version=version)
 		if val is None and default is not None:
 			if callable(default):
@@ -185,35 +299,104 @@ class BaseCache(object):
 			return self.get(key, default, version=version)
 		return val
 
-	def has_key(self, key, version=None):
+	def _get_or_set_locked(self, key, default, timeout, version,
+						lock_timeout, blocking_timeout, grace):
+		found, value, expires = self._get_stampede_entry(key, version)
+		if found and (expires is None or time.time() < expires):
+			return value
+
+		lock = self.lock('%s:stampede-lock' % key, version=version, timeout=lock_timeout)
+		if lock is None:
+			# The backend failed to create the lock (e.g. ignored connection
+			# errors). Just compute the value.
+			return self._set_stampede_entry(key, default, timeout, version, grace) \
+				if not found else value
+
+		if found:
+			# Only one caller refreshes the stale value. Everyone else gets
+			# the stale value immediately.
+			if not lock.acquire(blocking=False):
+				return value
+		elif not lock.acquire(blocking=True, blocking_timeout=blocking_timeout):
+			found, value, expires = self._get_stampede_entry(key, version)
+			if found:
+				return value
+			return self._set_stampede_entry(key, default, timeout, version, grace)
+
+		try:
+			found, value, expires = self._get_stampede_entry(key, version)
+			if found and (expires is None or time.time() < expires):
+				return value
+			return self._set_stampede_entry(key, default, timeout, version, grace)
+		finally:
+			try:
+				lock.release()
+			except Exception:
+				# The lock expired before we were done. Someone else might
+				# already be holding it.
+				pass
+
+	def _get_or_set_early(self, key, default, timeout, version, beta):
+		found, value, expires, delta = self._get_stampede_entry(key, version, with_delta=True)
+		if found and (expires is None or time.time() - delta * beta * math.log(random.random() or 1e-12) < expires):
+			return value
+		return self._set_stampede_entry(key, default, timeout, version)
+
+	def _get_stampede_entry(self, key, version, with_delta=False):
+		rv = self.get(key, version=version)
+		if isinstance(rv, (tuple, list)) and len(rv) == 4 and rv[0] == STAMPEDE_MARKER:
+			found, value, delta, expires = True, rv[1], rv[2], rv[3]
+		else:
+			found, value, delta, expires = False, None, 0, None
+		return (found, value, expires, delta) if with_delta else (found, value, expires)
+
+	def _set_stampede_entry(self, key, default, timeout, version, grace=None):
+		start = time.time()
+		value = default() if callable(default) else default
+		delta = time.time() - start
+		if value is None:
+			return value
+
+		timeout = self.get_timeout(timeout)
+		if timeout is not None and timeout > 0:
+			expires = time.time() + timeout
+			timeout += grace or 0
+		else:
+			expires = None
+
+		self.set(key, (STAMPEDE_MARKER, value, delta, expires), timeout=timeout, version=version)
+		return value
+
+	def has_key(self, key, version=None, tags=None):
 		"""
 		Returns True if the key is in the cache and has not expired.
 		"""
-		return self.get(key, version=version) is not None
+		return self.get(key, version=version, tags=tags) is not None
 
-	def incr(self, key, delta=1, default=None, timeout=DEFAULT_TIMEOUT, version=None):
+	def incr(self, key, delta=1, default=None, timeout=DEFAULT_TIMEOUT, version=None, tags=None):
 		"""
 		Add delta to value in the cache. If the key does not exist, raise a
 		ValueError exception.
 		"""
-		value = self.get(key, version=version)
+		tags = tags and self.get_tags_fingerprint(tags)
+		value = self.get(key, version=version, tags=tags)
 		if value is None:
 			if default is not None:
-				self.set(key, default, timeout=timeout, version=version)
+				self.set(key, default, timeout=timeout, version=version, tags=tags)
 				return default
 			else:
 				raise ValueError("Key '%s' not found" % key)
 
 		new_value = value + delta
-		self.set(key, new_value, version=version)
+		self.set(key, new_value, version=version, tags=tags)
 		return new_value
 
-	def decr(self, key, delta=1, default=None, timeout=DEFAULT_TIMEOUT, version=None):
+	def decr(self, key, delta=1, default=None, timeout=DEFAULT_TIMEOUT, version=None, tags=None):
 		"""
 		Subtract delta from value in the cache. If the key does not exist, raise
 		a ValueError exception.
 		"""
-		return self.incr(key, -delta, default=default, timeout=timeout, version=version)
+		return self.incr(key, -delta, default=default, timeout=timeout, version=version, tags=tags)
 
 	def __contains__(self, key):
 		"""
@@ -229,7 +412,7 @@ class BaseCache(object):
 		"""
 		raise NotImplementedError('subclasses of BaseCache must provide a lock() method')
 
-	def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+	def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None, tags=None):
 		"""
 		Set a bunch of values in the cache at once from a dict of key/value
 		pairs.  For certain backends (memcached), this is much more efficient
@@ -238,17 +421,19 @@ class BaseCache(object):
 		If timeout is given, that timeout will be used for the key; otherwise
 		the default cache timeout will be used.
 		"""
+		tags = tags and self.get_tags_fingerprint(tags)
 		for key, value in data.items():
-			self.set(key, value, timeout=timeout, version=version)
+			self.set(key, value, timeout=timeout, version=version, tags=tags)
 
-	def delete_many(self, keys, version=None):
+	def delete_many(self, keys, version=None, tags=None):
 		"""
 		Delete a bunch of values in the cache at once. For certain backends
 		(memcached), this is much more efficient than calling delete() multiple
 		times.
 		"""
+		tags = tags and self.get_tags_fingerprint(tags)
 		for key in keys:
-			self.delete(key, version=version)
+			self.delete(key, version=version, tags=tags)
 
 	def clear(self):
 		"""Remove *all* values from the cache at once."""
@@ -297,3 +482,129 @@ class BaseCache(object):
 	def close(self, **kwargs):
 		"""Close the cache connection"""
 		pass
+
+	#####################
+	# Async API.
+	#####################
+
+	@property
+	def async_executor(self):
+		"""The bounded thread pool used to run the blocking methods of backends
+		that have no native asyncio support. Its size is set with the
+		`async_max_workers` option (default 4).
+		"""
+		if self._async_executor is None:
+			with self._async_executor_lock:
+				if self._async_executor is None:
+					self._async_executor = ThreadPoolExecutor(self._async_max_workers)
+		return self._async_executor
+
+	async def aget_tags_fingerprint(self, tags):
+		"""Async version of :meth:`get_tags_fingerprint`."""
+		if isinstance(tags, TagsFingerprint):
+			return tags
+		return await self.run_async(self.get_tags_fingerprint, tags)
+
+	def run_async(self, func, *args, **kwargs):
+		"""Run the blocking func in the async_executor and return an awaitable
+		with its result.
+		"""
+		loop = asyncio.get_event_loop()
+		return loop.run_in_executor(self.async_executor, partial(func, *args, **kwargs))
+
+	async def aget(self, key, default=None, version=None, **kwargs):
+		"""Async version of :meth:`get`."""
+		return await self.run_async(self.get, key, default, version=version, **kwargs)
+
+	async def aset(self, key, value, timeout=DEFAULT_TIMEOUT, version=None, **kwargs):
+		"""Async version of :meth:`set`."""
+		return await self.run_async(self.set, key, value, timeout, version, **kwargs)
+
+	async def aadd(self, key, value, timeout=DEFAULT_TIMEOUT, version=None, **kwargs):
+		"""Async version of :meth:`add`."""
+		return await self.run_async(self.add, key, value, timeout, version, **kwargs)
+
+	async def aget_many(self, keys, version=None, **kwargs):
+		"""Async version of :meth:`get_many`."""
+		return await self.run_async(self.get_many, list(keys), version, **kwargs)
+
+	async def aset_many(self, data, timeout=DEFAULT_TIMEOUT, version=None, **kwargs):
+		"""Async version of :meth:`set_many`."""
+		return await self.run_async(self.set_many, data, timeout, version, **kwargs)
+
+	async def adelete(self, key, version=None, **kwargs):
+		"""Async version of :meth:`delete`."""
+		return await self.run_async(self.delete, key, version, **kwargs)
+
+	async def adelete_many(self, keys, version=None, **kwargs):
+		"""Async version of :meth:`delete_many`."""
+		return await self.run_async(self.delete_many, list(keys), version, **kwargs)
+
+	async def aincr(self, key, delta=1, *args, **kwargs):
+		"""Async version of :meth:`incr`."""
+		return await self.run_async(self.incr, key, delta, *args, **kwargs)
+
+	def alock(self, key, version=None, timeout=None, blocking_timeout=None):
+		"""Async version of :meth:`lock`. Returns an :class:`AsyncLock` with
+		awaitable `acquire()` and `release()` methods that can be used with
+		`async with`.
+		"""
+		return AsyncLock(self, self.lock(key, version, timeout, blocking_timeout))
+
+
+
+class AsyncLock(object):
+	"""Wraps a blocking cache lock so that it can be used from asyncio code.
+	The blocking calls are run in the cache's async_executor.
+	"""
+
+	__slots__ = ('cache', 'lock')
+
+	def __init__(self, cache, lock):
+		self.cache = cache
+		self.lock = lock
+
+	async def acquire(self, blocking=True, blocking_timeout=None):
+		return await self.cache.run_async(self.lock.acquire, blocking=blocking,
+							blocking_timeout=blocking_timeout)
+
+	async def release(self):
+		return await self.cache.run_async(self.lock.release)
+
+	def locked(self):
+		return self.lock.locked()
+
+	async def __aenter__(self):
+		if await self.acquire():
+			return self
+		raise RuntimeError('Unable to acquire lock within the time specified')
+
+	async def __aexit__(self, exc_type, exc_value, traceback):
+		await self.release()
+
+
+
+class AsyncCache(object):
+	"""Exposes the async API of a cache backend under the names of the
+	blocking API. So that `await acache.get(key)` calls `cache.aget(key)`.
+	"""
+
+	__slots__ = ('backend',)
+
+	def __init__(self, backend):
+		self.backend = backend
+
+	def lock(self, *args, **kwargs):
+		return self.backend.alock(*args, **kwargs)
+
+	def __getattr__(self, name):
+		try:
+			return getattr(self.backend, 'a' + name)
+		except AttributeError:
+			raise AttributeError(
+				'Cache backend %r has no async version of %r.'
+				% (self.backend.__class__.__name__, name)
+			)
+
+	def __repr__(self):
+		return '<AsyncCache %r>' % (self.backend,)
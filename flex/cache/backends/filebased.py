@@ -0,0 +1,355 @@
+"File-system cache backend."
+
+import os
+import time
+import mmap
+import errno
+import shutil
+import struct
+import hashlib
+import tempfile
+
+from .base import BaseCache, DEFAULT_TIMEOUT
+
+try:
+	import fcntl
+	fcntl_available = True
+except ImportError:
+	fcntl_available = False
+
+
+# Each cache file starts with the (absolute) time at which it expires as
+# a big-endian double. 0 means that it never expires.
+_header = struct.Struct('!d')
+
+
+class FileLock(object):
+	"""A lock on a single key of a :class:`FileBasedCache` backed by
+	`fcntl.flock()` on a lock file. It mimics the behavior of
+	:class:`threading.Lock` and works across processes on the same host.
+	The lock is released automatically if the holding process dies, so the
+	`timeout` given to :meth:`FileBasedCache.lock` is not needed.
+	"""
+
+	__slots__ = ('path', 'blocking_timeout', '_fd')
+
+	poll_interval = 0.005
+
+	def __init__(self, path, blocking_timeout=None):
+		if not fcntl_available:
+			raise RuntimeError('FileLock requires fcntl.')
+		self.path = path
+		self.blocking_timeout = blocking_timeout
+		self._fd = None
+
+	def acquire(self, blocking=True, blocking_timeout=None):
+		if blocking_timeout is None:
+			blocking_timeout = self.blocking_timeout
+
+		stop_at = None if blocking_timeout is None else time.monotonic() + blocking_timeout
+		fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+		try:
+			while True:
+				try:
+					fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+				except (IOError, OSError) as e:
+					if e.errno not in (errno.EAGAIN, errno.EACCES):
+						raise
+					if not blocking or (stop_at is not None and time.monotonic() >= stop_at):
+						os.close(fd)
+						return False
+					time.sleep(self.poll_interval)
+				else:
+					self._fd = fd
+					return True
+		except BaseException:
+			if self._fd is None:
+				os.close(fd)
+			raise
+
+	def release(self):
+		fd, self._fd = self._fd, None
+		if fd is None:
+			raise RuntimeError('Cannot release an unlocked lock')
+		try:
+			fcntl.flock(fd, fcntl.LOCK_UN)
+		finally:
+			os.close(fd)
+
+	def locked(self):
+		return self._fd is not None
+
+	def __enter__(self):
+		if self.acquire():
+			return self
+		raise RuntimeError('Unable to acquire lock within the time specified')
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.release()
+
+
+
+class FileBasedCache(BaseCache):
+	"""Cache backend that stores each entry in its own file.
+
+	Files are sharded into two levels of sub-directories by the md5 hash
+	of their key. Reads map the file into memory with `mmap` and decode the
+	value straight from the mapping. Writes go to a temporary file which is
+	then atomically renamed into place. This makes the cache safe to share
+	between several worker processes on the same host.
+
+	The cache is culled at most every `cull_interval` seconds (default 60)
+	per process, by one process at a time. Expired entries are removed first
+	and then, if there are more than `max_entries` entries or they take more
+	than `max_size` bytes (if set), the oldest written entries are removed
+	until 1/`cull_frequency` of the limit is free.
+	"""
+
+	cache_suffix = '.fcache'
+
+	lock_class = FileLock
+
+	def __init__(self, directory, params):
+		super(FileBasedCache, self).__init__(params)
+		self._dir = os.path.abspath(directory)
+		self._lock_dir = os.path.join(self._dir, '.locks')
+		max_size = params.get('max_size')
+		self._max_size = None if max_size is None else int(max_size)
+		self._cull_interval = params.get('cull_interval', 60)
+		self._last_cull = 0
+		os.makedirs(self._lock_dir, exist_ok=True)
+
+	def _key_to_file(self, key, version=None, tags=None):
+		"""Return the path of the file holding the given key."""
+		key = self.make_key(key, version=version, tags=tags)
+		name = hashlib.md5(key.encode('utf-8')).hexdigest()
+		return os.path.join(self._dir, name[:2], name[2:4], name + self.cache_suffix)
+
+	def _expires_at(self, timeout=DEFAULT_TIMEOUT):
+		timeout = self.get_timeout(timeout)
+		if timeout is None:
+			return 0
+		return time.time() + (timeout if timeout > 0 else -1)
+
+	def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None, tags=None):
+		fname = self._key_to_file(key, version, tags)
+		tmp = self._write_tmp(fname, self.encode(value), timeout)
+		try:
+			try:
+				# Linking fails if the file exists. Which makes add() atomic.
+				os.link(tmp, fname)
+			except FileExistsError:
+				if not self._is_expired(fname):
+					return False
+				os.replace(tmp, fname)
+		finally:
+			self._remove(tmp)
+		self._maybe_cull()
+		return True
+
+	def get(self, key, default=None, version=None, tags=None):
+		fname = self._key_to_file(key, version, tags)
+		try:
+			with open(fname, 'rb') as f:
+				stat = os.fstat(f.fileno())
+				if stat.st_size < _header.size:
+					return default
+
+				mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+				try:
+					expires, = _header.unpack_from(mm)
+					if expires and expires <= time.time():
+						self._remove_expired(fname, stat)
+						return default
+					return self._decode_mapped(mm)
+				finally:
+					try:
+						mm.close()
+					except BufferError:
+						# The decoded value still references the mapping.
+						# It's unmapped once the value is garbage collected.
+						pass
+		except FileNotFoundError:
+			return default
+
+	def _decode_mapped(self, mm):
+		with memoryview(mm) as view:
+			payload = view[_header.size:]
+			try:
+				if self._serializer is None:
+					return bytes(payload)
+				return self.decode(payload)
+			finally:
+				payload.release()
+
+	def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None, tags=None):
+		fname = self._key_to_file(key, version, tags)
+		tmp = self._write_tmp(fname, self.encode(value), timeout)
+		try:
+			os.replace(tmp, fname)
+		except BaseException:
+			self._remove(tmp)
+			raise
+		self._maybe_cull()
+		return True
+
+	def delete(self, key, version=None, tags=None):
+		return self._remove(self._key_to_file(key, version, tags))
+
+	def has_key(self, key, version=None, tags=None):
+		return not self._is_expired(self._key_to_file(key, version, tags))
+
+	def incr(self, key, delta=1, default=None, timeout=DEFAULT_TIMEOUT, version=None, tags=None):
+		tags = tags and self.get_tags_fingerprint(tags)
+		with self.lock(key, version=version):
+			return super(FileBasedCache, self).incr(key, delta, default, timeout, version, tags)
+
+	def ttl(self, key, version=None):
+		"""Return the remaining time to live of key in seconds, None if the key
+		never expires or 0 if the key does not exist.
+		"""
+		expires = self._read_expiry(self._key_to_file(key, version))
+		if expires is None:
+			return 0
+		elif not expires:
+			return None
+		return max(0, int(round(expires - time.time())))
+
+	def expire(self, key, timeout, version=None):
+		return self._write_expiry(self._key_to_file(key, version), self._expires_at(timeout))
+
+	def persist(self, key, version=None):
+		return self._write_expiry(self._key_to_file(key, version), 0)
+
+	def lock(self, key, version=None, timeout=None, blocking_timeout=None):
+		name = hashlib.md5(self.make_key(key, version=version).encode('utf-8')).hexdigest()
+		return self.lock_class(os.path.join(self._lock_dir, name + '.lock'),
+					blocking_timeout=blocking_timeout
+				)
+
+	def clear(self):
+		"""Remove all the cache files."""
+		for name in os.listdir(self._dir):
+			path = os.path.join(self._dir, name)
+			if path != self._lock_dir and os.path.isdir(path):
+				shutil.rmtree(path, ignore_errors=True)
+
+	def _write_tmp(self, fname, value, timeout):
+		"""Write the entry to a temporary file next to fname and return the
+		temporary file's path.
+		"""
+		dirname = os.path.dirname(fname)
+		os.makedirs(dirname, exist_ok=True)
+		fd, tmp = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+		try:
+			with open(fd, 'wb') as f:
+				f.write(_header.pack(self._expires_at(timeout)))
+				f.write(value)
+		except BaseException:
+			self._remove(tmp)
+			raise
+		return tmp
+
+	def _read_expiry(self, fname):
+		"""Return the expiry time stored in fname, 0 if it never expires or
+		None if it does not exist or has expired.
+		"""
+		try:
+			with open(fname, 'rb') as f:
+				header = f.read(_header.size)
+		except FileNotFoundError:
+			return None
+
+		if len(header) < _header.size:
+			return None
+
+		expires, = _header.unpack(header)
+		return None if expires and expires <= time.time() else expires
+
+	def _write_expiry(self, fname, expires):
+		if self._read_expiry(fname) is None:
+			return False
+		try:
+			fd = os.open(fname, os.O_WRONLY)
+		except FileNotFoundError:
+			return False
+		try:
+			os.pwrite(fd, _header.pack(expires), 0)
+		finally:
+			os.close(fd)
+		return True
+
+	def _is_expired(self, fname):
+		return self._read_expiry(fname) is None
+
+	def _remove_expired(self, fname, stat):
+		# Make sure the file was not replaced by another process before
+		# removing it.
+		try:
+			if os.stat(fname).st_ino == stat.st_ino:
+				os.remove(fname)
+		except FileNotFoundError:
+			pass
+
+	def _remove(self, fname):
+		try:
+			os.remove(fname)
+		except FileNotFoundError:
+			return False
+		return True
+
+	def _list_cache_files(self):
+		for root, dirs, files in os.walk(self._dir):
+			if root == self._dir and '.locks' in dirs:
+				dirs.remove('.locks')
+			for name in files:
+				if name.endswith(self.cache_suffix):
+					yield os.path.join(root, name)
+
+	def _maybe_cull(self):
+		now = time.time()
+		if now - self._last_cull < self._cull_interval:
+			return
+		self._last_cull = now
+
+		if not fcntl_available:
+			return self._cull()
+
+		lock = self.lock_class(os.path.join(self._lock_dir, '.cull.lock'))
+		if lock.acquire(blocking=False):
+			try:
+				self._cull()
+			finally:
+				lock.release()
+
+	def _cull(self):
+		entries, total_size = [], 0
+		for fname in self._list_cache_files():
+			try:
+				stat = os.stat(fname)
+			except FileNotFoundError:
+				continue
+			if self._is_expired(fname):
+				self._remove_expired(fname, stat)
+			else:
+				entries.append((stat.st_mtime, stat.st_size, fname))
+				total_size += stat.st_size
+
+		max_entries, max_size = self._max_entries, self._max_size
+		if len(entries) <= max_entries and (max_size is None or total_size <= max_size):
+			return
+		elif self._cull_frequency == 0:
+			return self.clear()
+
+		# Remove the oldest written entries until 1/cull_frequency of each
+		# limit is free.
+		keep_entries = max_entries - max_entries // self._cull_frequency
+		keep_size = None if max_size is None else max_size - max_size // self._cull_frequency
+		entries.sort()
+		count = len(entries)
+		for mtime, size, fname in entries:
+			if count <= keep_entries and (keep_size is None or total_size <= keep_size):
+				break
+			if self._remove(fname):
+				count -= 1
+				total_size -= size
@@ -0,0 +1,291 @@
+"Thread-safe in-process (local-memory) LRU cache backend."
+
+import math
+import time
+from uuid import uuid4
+from threading import RLock, Condition
+from collections import OrderedDict
+
+from .base import BaseCache, DEFAULT_TIMEOUT
+
+
+# Global in-memory stores of cache data. Keyed by name, to provide
+# multiple named local memory caches.
+_caches = {}
+_expire_info = {}
+_locks = {}
+_lock_conditions = {}
+_held_locks = {}
+
+
+class LocMemLock(object):
+	"""A lock on a single key of a :class:`LocMemCache` that mimics the
+	behavior of :class:`threading.Lock` (and that of redis-py's ``Lock``).
+
+	Held locks are shared by all instances of the cache with the same location
+	and auto-expire after `timeout` seconds if a timeout is given.
+	"""
+
+	__slots__ = ('cache', 'name', 'timeout', 'blocking_timeout', 'token')
+
+	def __init__(self, cache, name, timeout=None, blocking_timeout=None):
+		self.cache = cache
+		self.name = name
+		self.timeout = timeout
+		self.blocking_timeout = blocking_timeout
+		self.token = None
+
+	def acquire(self, blocking=True, blocking_timeout=None):
+		"""Block until the lock is released (or expires) or until
+		`blocking_timeout` seconds have elapsed.
+
+		Returns True if the lock was acquired, False otherwise.
+		"""
+		token = uuid4().hex
+		if blocking_timeout is None:
+			blocking_timeout = self.blocking_timeout
+
+		stop_at = None if blocking_timeout is None else time.monotonic() + blocking_timeout
+		held = self.cache._held_locks
+		cond = self.cache._lock_condition
+		with cond:
+			while True:
+				now = time.monotonic()
+				owner, expires = held.get(self.name, (None, None))
+				if owner is None or (expires is not None and expires <= now):
+					held[self.name] = token, (None if self.timeout is None else now + self.timeout)
+					self.token = token
+					return True
+
+				if not blocking:
+					return False
+
+				wait = None if expires is None else expires - now
+				if stop_at is not None:
+					remaining = stop_at - now
+					if remaining <= 0:
+						return False
+					wait = remaining if wait is None else min(wait, remaining)
+				cond.wait(wait)
+
+	def release(self):
+		token, self.token = self.token, None
+		if token is None:
+			raise RuntimeError('Cannot release an unlocked lock')
+
+		held = self.cache._held_locks
+		cond = self.cache._lock_condition
+		with cond:
+			owner, expires = held.get(self.name, (None, None))
+			if owner != token or (expires is not None and expires <= time.monotonic()):
+				raise RuntimeError('Cannot release a lock that\'s no longer owned')
+			del held[self.name]
+			cond.notify_all()
+
+	def locked(self):
+		owner, expires = self.cache._held_locks.get(self.name, (None, None))
+		return owner is not None and (expires is None or expires > time.monotonic())
+
+	def __enter__(self):
+		if self.acquire():
+			return self
+		raise RuntimeError('Unable to acquire lock within the time specified')
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.release()
+
+
+
+class LocMemCache(BaseCache):
+	"""Thread-safe local-memory cache.
+
+	Entries are kept in LRU order in an `OrderedDict` so that lookups, updates
+	and evictions are all O(1). Expired entries are removed lazily when
+	accessed and in bulk when the cache is culled. Once `max_entries` is
+	reached, `1/cull_frequency` of the entries (least recently used first)
+	are evicted. A `cull_frequency` of 0 clears the entire cache instead.
+
+	Caches with the same `name` (location) share their data within a process.
+	"""
+
+	lock_class = LocMemLock
+
+	def __init__(self, name, params):
+		super(LocMemCache, self).__init__(params)
+		self.name = name = name or ''
+		self._cache = _caches.setdefault(name, OrderedDict())
+		self._expire_info = _expire_info.setdefault(name, {})
+		self._lock = _locks.setdefault(name, RLock())
+		self._lock_condition = _lock_conditions.setdefault(name, Condition(self._lock))
+		self._held_locks = _held_locks.setdefault(name, {})
+
+	def get_backend_timeout(self, timeout=DEFAULT_TIMEOUT):
+		"""Return the monotonic time at which a key set with the given timeout
+		expires or None if it never expires.
+		"""
+		timeout = self.get_timeout(timeout)
+		if timeout is None:
+			return None
+		return time.monotonic() + (timeout if timeout > 0 else -1)
+
+	def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None, tags=None):
+		key = self.make_key(key, version=version, tags=tags)
+		self.validate_key(key)
+		value = self.encode(value)
+		with self._lock:
+			if self._has_expired(key):
+				self._set(key, value, timeout)
+				return True
+			return False
+
+	def get(self, key, default=None, version=None, tags=None):
+		key = self.make_key(key, version=version, tags=tags)
+		with self._lock:
+			if self._has_expired(key):
+				self._delete(key)
+				return default
+			value = self._cache[key]
+			self._cache.move_to_end(key, last=False)
+		return self.decode(value)
+
+	def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None, tags=None):
+		key = self.make_key(key, version=version, tags=tags)
+		self.validate_key(key)
+		value = self.encode(value)
+		with self._lock:
+			self._set(key, value, timeout)
+		return True
+
+	def delete(self, key, version=None, tags=None):
+		key = self.make_key(key, version=version, tags=tags)
+		with self._lock:
+			return self._delete(key)
+
+	def get_many(self, keys, version=None, tags=None):
+		tags = tags and self.get_tags_fingerprint(tags)
+		rv = {}
+		with self._lock:
+			for k in keys:
+				key = self.make_key(k, version=version, tags=tags)
+				if self._has_expired(key):
+					self._delete(key)
+				else:
+					rv[k] = self._cache[key]
+					self._cache.move_to_end(key, last=False)
+		return {k: self.decode(v) for k, v in rv.items()}
+
+	def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None, tags=None):
+		tags = tags and self.get_tags_fingerprint(tags)
+		data = {self.make_key(k, version=version, tags=tags): self.encode(v) for k, v in data.items()}
+		with self._lock:
+			for key, value in data.items():
+				self._set(key, value, timeout)
+
+	def delete_many(self, keys, version=None, tags=None):
+		tags = tags and self.get_tags_fingerprint(tags)
+		keys = [self.make_key(k, version=version, tags=tags) for k in keys]
+		with self._lock:
+			return sum(1 for key in keys if self._delete(key))
+
+	def has_key(self, key, version=None, tags=None):
+		key = self.make_key(key, version=version, tags=tags)
+		with self._lock:
+			if self._has_expired(key):
+				self._delete(key)
+				return False
+			return True
+
+	def incr(self, key, delta=1, default=None, timeout=DEFAULT_TIMEOUT, version=None, tags=None):
+		ck = self.make_key(key, version=version, tags=tags)
+		self.validate_key(ck)
+		with self._lock:
+			if self._has_expired(ck):
+				self._delete(ck)
+				if default is None:
+					raise ValueError("Key '%s' not found" % key)
+				self._set(ck, self.encode(default), timeout)
+				return default
+
+			value = self.decode(self._cache[ck]) + delta
+			self._cache[ck] = self.encode(value)
+			self._cache.move_to_end(ck, last=False)
+		return value
+
+	def decr(self, key, delta=1, default=None, timeout=DEFAULT_TIMEOUT, version=None, tags=None):
+		return self.incr(key, -delta, default=default, timeout=timeout, version=version, tags=tags)
+
+	def ttl(self, key, version=None):
+		"""Return the remaining time to live of key in seconds, None if the key
+		never expires or 0 if the key does not exist.
+		"""
+		key = self.make_key(key, version=version)
+		with self._lock:
+			if self._has_expired(key):
+				return 0
+			exp = self._expire_info[key]
+			return None if exp is None else max(0, math.ceil(exp - time.monotonic()))
+
+	def persist(self, key, version=None):
+		key = self.make_key(key, version=version)
+		with self._lock:
+			if self._has_expired(key):
+				return False
+			self._expire_info[key] = None
+			return True
+
+	def expire(self, key, timeout, version=None):
+		key = self.make_key(key, version=version)
+		with self._lock:
+			if self._has_expired(key):
+				return False
+			self._expire_info[key] = self.get_backend_timeout(timeout)
+			return True
+
+	def lock(self, key, version=None, timeout=None, blocking_timeout=None):
+		return self.lock_class(self, self.make_key(key, version=version),
+					timeout=timeout,
+					blocking_timeout=blocking_timeout
+				)
+
+	def clear(self):
+		with self._lock:
+			self._cache.clear()
+			self._expire_info.clear()
+
+	def _set(self, key, value, timeout=DEFAULT_TIMEOUT):
+		if key not in self._cache and len(self._cache) >= self._max_entries:
+			self._cull()
+		self._cache[key] = value
+		self._cache.move_to_end(key, last=False)
+		self._expire_info[key] = self.get_backend_timeout(timeout)
+
+	def _delete(self, key):
+		try:
+			del self._cache[key]
+			del self._expire_info[key]
+		except KeyError:
+			return False
+		return True
+
+	def _has_expired(self, key):
+		"""Return True if key is missing or has expired."""
+		exp = self._expire_info.get(key, -1)
+		return exp is not None and exp <= time.monotonic()
+
+	def _cull(self):
+		now = time.monotonic()
+		expired = [k for k, exp in self._expire_info.items() if exp is not None and exp <= now]
+		for key in expired:
+			self._delete(key)
+
+		if len(self._cache) < self._max_entries:
+			return
+
+		if self._cull_frequency == 0:
+			self._cache.clear()
+			self._expire_info.clear()
+		else:
+			count = max(1, len(self._cache) // self._cull_frequency)
+			for i in range(count):
+				key, _ = self._cache.popitem()
+				del self._expire_info[key]
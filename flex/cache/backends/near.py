@@ -0,0 +1,311 @@
+"Two-tier near-cache: a small in-process L1 in front of a shared Redis L2."
+
+import os
+import logging
+import threading
+from uuid import uuid4
+
+from .base import BaseCache, DEFAULT_TIMEOUT
+from .locmem import LocMemCache
+from .redis import RedisCache, omit_exception
+
+
+logger = logging.getLogger(__name__)
+
+
+class NearCache(RedisCache):
+	"""A :class:`RedisCache` with a bounded, TTL-capped per-process L1 cache.
+
+	Reads are served from the local L1 (a :class:`LocMemCache` holding the
+	encoded values) when possible and fall back to Redis (L2). Every write or
+	delete is broadcast over Redis pub/sub so that other workers drop their
+	now stale L1 entries. Since invalidation is asynchronous, an L1 entry may
+	outlive a remote write by a short moment, but never by more than
+	`local_timeout` seconds.
+
+	Extra options:
+		local_timeout: max number of seconds a key lives in L1 (default 5).
+		local_max_entries: max number of keys kept in L1 (default 1000).
+		local_cull_frequency: L1 cull frequency (default 3).
+		invalidation_channel: the pub/sub channel used for invalidation.
+
+	Like :class:`RedisCache`, `client_class` can point to any client with
+	redis-py's API, including local stand-ins such as fakeredis.
+	"""
+
+	def __init__(self, url, options):
+		super(NearCache, self).__init__(url, options)
+		self.local_timeout = int(options.get('local_timeout', 5))
+		self.local = LocMemCache('near:%s:%s' % (self._url, self.key_prefix or ''), dict(
+					timeout=self.local_timeout,
+					max_entries=options.get('local_max_entries', 1000),
+					cull_frequency=options.get('local_cull_frequency', 3),
+					serializer=None,
+					key_function=lambda key, prefix=None, version=None, reverse=False: key,
+				))
+		self.channel = options.get('invalidation_channel') \
+			or '%s:near-cache:invalidate' % (self.key_prefix or 'flex',)
+		self.origin = uuid4().hex
+		self._listener = None
+		self._listener_pid = None
+		self._listener_lock = threading.Lock()
+		self._listener_stop = None
+		self._pubsub = None
+		self.l1_hits = self.l2_hits = self.misses = 0
+
+	def stats(self):
+		"""Return the L1 and L2 hit counts and the number of misses."""
+		return dict(l1_hits=self.l1_hits, l2_hits=self.l2_hits, misses=self.misses)
+
+	def reset_stats(self):
+		self.l1_hits = self.l2_hits = self.misses = 0
+
+	def _local_timeout(self, timeout=DEFAULT_TIMEOUT):
+		timeout = self.get_timeout(timeout)
+		if timeout is None:
+			return self.local_timeout
+		return min(timeout, self.local_timeout) if timeout > 0 else 0
+
+	def get(self, key, default=None, version=None, tags=None):
+		self.ensure_listener()
+		tags = tags and self.get_tags_fingerprint(tags)
+		ck = self.make_key(key, version, tags=tags)
+		rv = self.local.get(ck)
+		if rv is not None:
+			self.l1_hits += 1
+			return self.decode(rv)
+
+		rv = self._get(key, version, tags)
+		if rv is None:
+			self.misses += 1
+			return default
+
+		self.l2_hits += 1
+		self.local.set(ck, rv)
+		return self.decode(rv)
+
+	def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None, tags=None):
+		self.ensure_listener()
+		ck = self.make_key(key, version, tags=tags)
+		value = self.encode(value)
+		rv = self._set_raw(ck, value, timeout)
+		if rv:
+			self.local.set(ck, value, self._local_timeout(timeout))
+			self.publish(ck)
+		return rv
+
+	def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None, tags=None):
+		self.ensure_listener()
+		ck = self.make_key(key, version, tags=tags)
+		value = self.encode(value)
+		rv = self._set_raw(ck, value, timeout, nx=True)
+		if rv:
+			self.local.set(ck, value, self._local_timeout(timeout))
+			self.publish(ck)
+		return rv
+
+	@omit_exception
+	def _set_raw(self, ck, value, timeout=DEFAULT_TIMEOUT, nx=False):
+		return self.client.set(ck, value, self.get_timeout(timeout), nx=nx)
+
+	def get_many(self, keys, version=None, tags=None):
+		"""Serve what's possible from L1 and fetch the rest from L2 with a
+		single MGET.
+		"""
+		self.ensure_listener()
+		tags = tags and self.get_tags_fingerprint(tags)
+		cks = {self.make_key(k, version, tags=tags): k for k in keys}
+		found = self.local.get_many(cks)
+		self.l1_hits += len(found)
+
+		missing = [ck for ck in cks if ck not in found]
+		if missing:
+			values = self._mget(missing) or ()
+			for ck, value in zip(missing, values):
+				if value is None:
+					self.misses += 1
+				else:
+					self.l2_hits += 1
+					self.local.set(ck, value)
+					found[ck] = value
+		return {cks[ck]: self.decode(v) for ck, v in found.items()}
+
+	@omit_exception
+	def _mget(self, cks):
+		return self.client.mget(cks)
+
+	def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None, tags=None):
+		self.ensure_listener()
+		tags = tags and self.get_tags_fingerprint(tags)
+		super(NearCache, self).set_many(data, timeout, version, tags)
+		cks = [self.make_key(k, version, tags=tags) for k in data]
+		self.local.delete_many(cks)
+		if cks:
+			self.publish(*cks)
+
+	def delete(self, key, version=None, tags=None):
+		tags = tags and self.get_tags_fingerprint(tags)
+		ck = self.make_key(key, version, tags=tags)
+		self.local.delete(ck)
+		rv = super(NearCache, self).delete(key, version, tags)
+		self.publish(ck)
+		return rv
+
+	def delete_many(self, keys, version=None, tags=None):
+		tags = tags and self.get_tags_fingerprint(tags)
+		cks = [self.make_key(k, version, tags=tags) for k in keys]
+		self.local.delete_many(cks)
+		rv = super(NearCache, self).delete_many(keys, version, tags)
+		if cks:
+			self.publish(*cks)
+		return rv
+
+	def delete_pattern(self, pattern, version=None, count=None, batch_size=None):
+		self.local.clear()
+		rv = super(NearCache, self).delete_pattern(pattern, version, count, batch_size)
+		self.publish()
+		return rv
+
+	def clear(self):
+		self.local.clear()
+		rv = super(NearCache, self).clear()
+		self.publish()
+		return rv
+
+	def incr(self, key, delta=1, default=None, timeout=DEFAULT_TIMEOUT, version=None, tags=None):
+		tags = tags and self.get_tags_fingerprint(tags)
+		ck = self.make_key(key, version, tags=tags)
+		self.local.delete(ck)
+		rv = super(NearCache, self).incr(key, delta, default, timeout, version, tags)
+		self.publish(ck)
+		return rv
+
+	def decr(self, key, delta=1, version=None, tags=None):
+		tags = tags and self.get_tags_fingerprint(tags)
+		ck = self.make_key(key, version, tags=tags)
+		self.local.delete(ck)
+		rv = super(NearCache, self).decr(key, delta, version, tags)
+		self.publish(ck)
+		return rv
+
+	def cas(self, key, expected, value, timeout=DEFAULT_TIMEOUT, version=None, tags=None):
+		tags = tags and self.get_tags_fingerprint(tags)
+		ck = self.make_key(key, version, tags=tags)
+		self.local.delete(ck)
+		rv = super(NearCache, self).cas(key, expected, value, timeout, version, tags)
+		if rv:
+			self.publish(ck)
+		return rv
+
+	def incr_version(self, key, delta=1, version=None):
+		ck = self.make_key(key, version)
+		self.local.delete(ck)
+		rv = super(NearCache, self).incr_version(key, delta, version)
+		self.publish(ck)
+		return rv
+
+	def expire(self, key, timeout, version=None):
+		ck = self.make_key(key, version)
+		self.local.delete(ck)
+		rv = super(NearCache, self).expire(key, timeout, version)
+		self.publish(ck)
+		return rv
+
+	# The L1 and invalidation logic is blocking. So the async API runs the
+	# blocking methods in the thread pool instead of using the async client.
+	aget = BaseCache.aget
+	aset = BaseCache.aset
+	aadd = BaseCache.aadd
+	aget_many = BaseCache.aget_many
+	aset_many = BaseCache.aset_many
+	adelete = BaseCache.adelete
+	adelete_many = BaseCache.adelete_many
+	aincr = BaseCache.aincr
+	alock = BaseCache.alock
+
+	def clear_local(self):
+		"""Drop all entries in this process's L1."""
+		self.local.clear()
+
+	@omit_exception
+	def publish(self, *keys):
+		"""Tell other workers to drop the given (already made) keys from their
+		L1. If no keys are given, the whole L1 is dropped. All the keys are
+		sent in a single message, one per line.
+		"""
+		self.client.publish(self.channel, '%s:%s' % (self.origin, '\n'.join(keys)))
+
+	def close(self, **kwargs):
+		"""Stop this process's invalidation listener. It's started again the
+		next time the cache is used.
+		"""
+		with self._listener_lock:
+			listener, self._listener = self._listener, None
+			if self._listener_stop is not None:
+				self._listener_stop.set()
+			pubsub, self._pubsub = self._pubsub, None
+			self._listener_pid = None
+
+		if pubsub is not None:
+			try:
+				pubsub.close()
+			except Exception as e:
+				logger.warning('Failed to close the near-cache invalidation pubsub: %s' % e)
+		if listener is not None and listener is not threading.current_thread():
+			listener.join(5)
+		super(NearCache, self).close(**kwargs)
+
+	def ensure_listener(self):
+		"""Start the invalidation listener thread for the current process if
+		it's not running. The pid is checked so that forked workers start their
+		own listener.
+		"""
+		if self._listener_pid == os.getpid():
+			return
+
+		with self._listener_lock:
+			if self._listener_pid != os.getpid():
+				# The L1 may have been filled before a fork. Clear it as we
+				# might have missed invalidations in the meantime.
+				self.local.clear()
+				self._listener_stop = stop = threading.Event()
+				self._listener = threading.Thread(target=self._listen, args=(stop,),
+								name='near-cache-invalidation', daemon=True)
+				self._listener.start()
+				self._listener_pid = os.getpid()
+
+	def _listen(self, stop):
+		while not stop.is_set():
+			try:
+				pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+				with self._listener_lock:
+					if stop.is_set():
+						return
+					self._pubsub = pubsub
+				pubsub.subscribe(self.channel)
+				# Messages could have been missed while (re)connecting.
+				self.local.clear()
+				while not stop.is_set():
+					# Polled so that close() can stop the thread.
+					message = pubsub.get_message(timeout=1.0)
+					if message and message.get('type') == 'message':
+						self._on_invalidate(message['data'])
+			except Exception as e:
+				# Closing the pubsub from close() ends up here too.
+				if stop.is_set():
+					return
+				logger.error('Near-cache invalidation listener: %s' % e)
+				self.local.clear()
+				stop.wait(1)
+
+	def _on_invalidate(self, data):
+		if isinstance(data, bytes):
+			data = data.decode('utf-8')
+
+		origin, _, keys = data.partition(':')
+		if origin == self.origin:
+			return
+		elif keys:
+			self.local.delete_many(keys.split('\n'))
+		else:
+			self.local.clear()
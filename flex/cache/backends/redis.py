@@ -1,10 +1,15 @@
-import functools
-import logging
+import re
 import socket
+import asyncio
+import logging
+import functools
+from weakref import WeakKeyDictionary
+from threading import Lock
 
 from flex.conf import config
+from flex.redis import get_client
 from flex.utils.module_loading import import_string
-from .base import BaseCache, DEFAULT_TIMEOUT
+from .base import BaseCache, AsyncLock, DEFAULT_TIMEOUT
 from flex.utils.decorators import locked_cached_property
 
 from redis.exceptions import ConnectionError, ResponseError, TimeoutError
@@ -16,10 +21,72 @@ logger = logging.getLogger((REDIS_LOGGER or __name__))
 
 _connection_errors = (TimeoutError, ResponseError, ConnectionError, socket.timeout)
 
+# Characters escaped in key prefixes used in SCAN patterns.
+_GLOB_CHARS = re.compile(r'[*?\[\]\\]')
+
 
 NOTHING = object()
 
 
+#: Lua scripts preloaded by :class:`RedisCache` and run with EVALSHA. Each
+#: one makes a read-modify-write operation a single atomic round trip.
+#: A timeout argument of '' means no expiry.
+LUA_SCRIPTS = dict(
+	# KEYS: key. ARGV: delta, default, timeout.
+	incr="""
+		if ARGV[2] ~= '' and redis.call('EXISTS', KEYS[1]) == 0 then
+			redis.call('SET', KEYS[1], ARGV[2])
+			if ARGV[3] ~= '' then
+				redis.call('EXPIRE', KEYS[1], ARGV[3])
+			end
+			return tonumber(ARGV[2])
+		end
+		return redis.call('INCRBY', KEYS[1], ARGV[1])
+	""",
+	# KEYS: key. ARGV: timeout.
+	get_and_touch="""
+		local value = redis.call('GET', KEYS[1])
+		if value then
+			if ARGV[1] == '' then
+				redis.call('PERSIST', KEYS[1])
+			else
+				redis.call('EXPIRE', KEYS[1], ARGV[1])
+			end
+		end
+		return value
+	""",
+	# KEYS: key. ARGV: expected value, new value, timeout.
+	cas="""
+		if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+			return 0
+		end
+		if ARGV[3] == '' then
+			redis.call('SET', KEYS[1], ARGV[2])
+		elseif tonumber(ARGV[3]) > 0 then
+			redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+		else
+			redis.call('DEL', KEYS[1])
+		end
+		return 1
+	""",
+	# KEYS: old key, new key. Moves the value and keeps its ttl.
+	move_version="""
+		local value = redis.call('GET', KEYS[1])
+		if not value then
+			return 0
+		end
+		local ttl = redis.call('PTTL', KEYS[1])
+		if ttl > 0 then
+			redis.call('SET', KEYS[2], value, 'PX', ttl)
+		else
+			redis.call('SET', KEYS[2], value)
+		end
+		redis.call('DEL', KEYS[1])
+		return 1
+	""",
+)
+
+
 def omit_exception(method=None, return_value=None):
 	"""
 	Simple decorator that intercepts connection
@@ -29,6 +96,20 @@ def omit_exception(method=None, return_value=None):
 	if method is None:
 		return functools.partial(omit_exception, return_value=return_value)
 
+	if asyncio.iscoroutinefunction(method):
+		@functools.wraps(method)
+		async def _async_decorator(self, *args, **kwargs):
+			try:
+				return await method(self, *args, **kwargs)
+			except _connection_errors as e:
+				if self._ignore_exceptions:
+					if self._log_ignored_exceptions:
+						logger.error(str(e))
+
+					return return_value
+				raise e
+		return _async_decorator
+
 	@functools.wraps(method)
 	def _decorator(self, *args, **kwargs):
 		try:
@@ -58,75 +139,198 @@ class RedisCache(BaseCache):
 			self._client_cls = import_string(self._client_cls)
 
 		self._client_options = params.get('client_options', {})
+
+		# redis-py's asyncio client (redis >= 4.2). If not available, the async
+		# API falls back to running the blocking client in a thread pool.
+		self._async_client_cls = params.get("async_client_class", "redis.asyncio.StrictRedis")
+		if isinstance(self._async_client_cls, str):
+			self._async_client_cls = import_string(self._async_client_cls, silent=True)
+		self._async_clients = WeakKeyDictionary()
+		self._async_clients_lock = Lock()
+		self._delete_batch_size = int(params.get('delete_batch_size', 1000))
+		self._use_unlink = params.get('use_unlink', True)
 		self._ignore_exceptions = params.get("ignore_exceptions", False)
 		self._log_ignored_exceptions = params.get("log_ignored_exceptions", True)
 
 	@locked_cached_property
 	def client(self):
-		return self._client_cls.from_url(self._url, **self._client_options)
+		return get_client(self._url, self._client_cls, **self._client_options)
+
+	@locked_cached_property
+	def scripts(self):
+		"""The :data:`LUA_SCRIPTS` registered on the client. They are called with
+		EVALSHA and (re)loaded automatically if the server doesn't know them.
+		"""
+		return {name: self.client.register_script(src) for name, src in LUA_SCRIPTS.items()}
+
+	@omit_exception
+	def load_scripts(self):
+		"""Preload the Lua scripts on the server."""
+		for script in self.scripts.values():
+			script.sha = self.client.script_load(script.script)
+
+	def _script_timeout(self, timeout=DEFAULT_TIMEOUT):
+		timeout = self.get_timeout(timeout)
+		return '' if timeout is None else timeout
 
 	@omit_exception
-	def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+	def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None, tags=None):
 		return self.client.set(
-					self.make_key(key, version),
+					self.make_key(key, version, tags=tags),
 					self.encode(value),
 					self.get_timeout(timeout)
 				)
 
 	@omit_exception
-	def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+	def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None, tags=None):
 		return self.client.set(
-					self.make_key(key, version),
+					self.make_key(key, version, tags=tags),
 					self.encode(value),
 					self.get_timeout(timeout),
 					nx=True
 				)
 
 	@omit_exception
-	def _get(self, key, version=None):
-		return self.client.get(self.make_key(key, version))
+	def _get(self, key, version=None, tags=None):
+		return self.client.get(self.make_key(key, version, tags=tags))
 
-	def get(self, key, default=None, version=None):
-		rv = self._get(key, version)
+	def get(self, key, default=None, version=None, tags=None):
+		rv = self._get(key, version, tags)
 		if rv is not None:
 			return self.decode(rv)
 
+	@omit_exception(return_value={})
+	def get_many(self, keys, version=None, tags=None):
+		"""Fetch a bunch of keys from the cache with a single MGET."""
+		keys = list(keys)
+		if not keys:
+			return {}
+
+		tags = tags and self.get_tags_fingerprint(tags)
+		values = self.client.mget([self.make_key(k, version, tags=tags) for k in keys])
+		return {k: self.decode(v) for k, v in zip(keys, values) if v is not None}
+
+	@omit_exception
+	def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None, tags=None):
+		"""Set a bunch of values in the cache in a single pipeline. Unlike
+		MSET, every key gets the given timeout.
+		"""
+		if not data:
+			return
+
+		timeout = self.get_timeout(timeout)
+		tags = tags and self.get_tags_fingerprint(tags)
+		pipe = self.client.pipeline(transaction=False)
+		for key, value in data.items():
+			pipe.set(self.make_key(key, version, tags=tags), self.encode(value), timeout)
+		pipe.execute()
+
 	@omit_exception
 	def incr_version(self, key, delta=1, version=None):
-		return super(RedisCache, self).incr_version(key, delta, version)
+		"""Atomically move the value of key to version + delta, keeping its
+		ttl. Returns the new version.
+		"""
+		if version is None:
+			version = self.version
+
+		keys = [self.make_key(key, version), self.make_key(key, version + delta)]
+		if not self.scripts['move_version'](keys=keys):
+			raise ValueError("Key '%s' not found" % key)
+		return version + delta
 
 	@omit_exception
-	def delete(self, key, version=None):
-		return self.client.delete(self.make_key(key, version))
+	def get_and_touch(self, key, default=None, timeout=DEFAULT_TIMEOUT, version=None, tags=None):
+		"""Fetch a given key from the cache and reset its timeout in one
+		atomic round trip.
+		"""
+		rv = self.scripts['get_and_touch'](
+					keys=[self.make_key(key, version, tags=tags)],
+					args=[self._script_timeout(timeout)]
+				)
+		return default if rv is None else self.decode(rv)
 
 	@omit_exception
-	def delete_pattern(self, pattern, version=None, count=None):
-		c = 0
-		for key in self.client.scan_iter(self.make_key(pattern, version), count):
-			self.client.delete(key)
-			c += 1
-		return c
+	def cas(self, key, expected, value, timeout=DEFAULT_TIMEOUT, version=None, tags=None):
+		"""Set key to value only if its current value is `expected` (compared
+		in their encoded form). If `expected` is None, the key is only set if
+		it doesn't exist. Returns True if the value was set.
+		"""
+		if expected is None:
+			return bool(self.add(key, value, timeout, version, tags))
+
+		return bool(self.scripts['cas'](
+					keys=[self.make_key(key, version, tags=tags)],
+					args=[self.encode(expected), self.encode(value), self._script_timeout(timeout)]
+				))
 
 	@omit_exception
-	def delete_many(self, keys, version=None):
-		return self.client.delete(*(self.make_key(k, version) for k in keys))
+	def delete(self, key, version=None, tags=None):
+		return self.client.delete(self.make_key(key, version, tags=tags))
 
 	@omit_exception
-	def incr(self, key, delta=1, default=None, timeout=DEFAULT_TIMEOUT, version=None):
-		ck = self.make_key(key, version)
-		if ck not in self.client and default is not None:
-			self.client.set(ck, default, self.get_timeout(timeout), nx=True)
-			return default
+	def delete_pattern(self, pattern, version=None, count=None, batch_size=None):
+		"""Delete all keys matching pattern. The keys found with SCAN are
+		unlinked in batches of `batch_size` (defaults to the `delete_batch_size`
+		option) instead of one command per key.
+		"""
+		return self._unlink_matching(self.make_key(pattern, version), count, batch_size)
 
-		return self.client.incr(ck, delta)
+	@omit_exception
+	def clear(self):
+		"""Delete all keys of the cache, i.e. all keys starting with the
+		`key_prefix` (of any version). Without a `key_prefix` this is every
+		key in the database.
+		"""
+		prefix = self.key_prefix and _GLOB_CHARS.sub(r'\\\g<0>', str(self.key_prefix))
+		return self._unlink_matching(self.key_func('*', prefix))
+
+	def _unlink_matching(self, match, count=None, batch_size=None):
+		batch_size = batch_size or self._delete_batch_size
+		c, batch = 0, []
+		for key in self.client.scan_iter(match, count):
+			batch.append(key)
+			if len(batch) >= batch_size:
+				c += self._unlink(*batch)
+				batch = []
+		if batch:
+			c += self._unlink(*batch)
+		return c
+
+	@omit_exception
+	def delete_many(self, keys, version=None, tags=None):
+		tags = tags and self.get_tags_fingerprint(tags)
+		keys = [self.make_key(k, version, tags=tags) for k in keys]
+		return self.client.delete(*keys) if keys else 0
+
+	def _unlink(self, *keys):
+		"""Delete the given (already made) keys with a single UNLINK. Falls
+		back to DEL for servers that don't support UNLINK (< 4.0).
+		"""
+		if self._use_unlink:
+			try:
+				return self.client.execute_command('UNLINK', *keys)
+			except ResponseError:
+				self._use_unlink = False
+		return self.client.delete(*keys)
 
 	@omit_exception
-	def decr(self, key, delta=1, version=None):
-		return self.client.decr(self.make_key(key, version), delta)
+	def incr(self, key, delta=1, default=None, timeout=DEFAULT_TIMEOUT, version=None, tags=None):
+		"""Increment key by delta. If the key doesn't exist and a default is
+		given, it's set to default with the given timeout instead. Done
+		atomically in a single round trip.
+		"""
+		return self.scripts['incr'](
+					keys=[self.make_key(key, version, tags=tags)],
+					args=[delta, '' if default is None else default, self._script_timeout(timeout)]
+				)
 
 	@omit_exception
-	def has_key(self, key, version=None):
-		return self.client.exists(self.make_key(key, version))
+	def decr(self, key, delta=1, version=None, tags=None):
+		return self.client.decr(self.make_key(key, version, tags=tags), delta)
+
+	@omit_exception
+	def has_key(self, key, version=None, tags=None):
+		return self.client.exists(self.make_key(key, version, tags=tags))
 
 	# @omit_exception
 	# def keys(self, *args, **kwargs):
@@ -158,3 +362,119 @@ class RedisCache(BaseCache):
 	@omit_exception
 	def close(self, **kwargs):
 		pass
+
+	#####################
+	# Async API.
+	#####################
+
+	@property
+	def async_client(self):
+		"""The asyncio client for the running event loop. asyncio connections
+		are bound to their loop, so one client is kept per loop.
+		"""
+		loop = asyncio.get_event_loop()
+		rv = self._async_clients.get(loop)
+		if rv is None:
+			with self._async_clients_lock:
+				rv = self._async_clients.get(loop)
+				if rv is None:
+					rv = self._async_clients[loop] = self._async_client_cls.from_url(
+								self._url, **self._client_options)
+		return rv
+
+	async def aget(self, key, default=None, version=None, tags=None):
+		if self._async_client_cls is None:
+			return await super(RedisCache, self).aget(key, default, version, tags=tags)
+
+		tags = tags and await self.aget_tags_fingerprint(tags)
+		rv = await self._aget(key, version, tags)
+		return default if rv is None else self.decode(rv)
+
+	@omit_exception
+	async def _aget(self, key, version=None, tags=None):
+		return await self.async_client.get(self.make_key(key, version, tags=tags))
+
+	@omit_exception
+	async def aset(self, key, value, timeout=DEFAULT_TIMEOUT, version=None, tags=None):
+		if self._async_client_cls is None:
+			return await super(RedisCache, self).aset(key, value, timeout, version, tags=tags)
+
+		tags = tags and await self.aget_tags_fingerprint(tags)
+		return await self.async_client.set(
+					self.make_key(key, version, tags=tags),
+					self.encode(value),
+					self.get_timeout(timeout)
+				)
+
+	@omit_exception
+	async def aadd(self, key, value, timeout=DEFAULT_TIMEOUT, version=None, tags=None):
+		if self._async_client_cls is None:
+			return await super(RedisCache, self).aadd(key, value, timeout, version, tags=tags)
+
+		tags = tags and await self.aget_tags_fingerprint(tags)
+		return await self.async_client.set(
+					self.make_key(key, version, tags=tags),
+					self.encode(value),
+					self.get_timeout(timeout),
+					nx=True
+				)
+
+	@omit_exception(return_value={})
+	async def aget_many(self, keys, version=None, tags=None):
+		if self._async_client_cls is None:
+			return await super(RedisCache, self).aget_many(keys, version, tags=tags)
+
+		keys = list(keys)
+		if not keys:
+			return {}
+
+		tags = tags and await self.aget_tags_fingerprint(tags)
+		values = await self.async_client.mget([self.make_key(k, version, tags=tags) for k in keys])
+		return {k: self.decode(v) for k, v in zip(keys, values) if v is not None}
+
+	@omit_exception
+	async def aset_many(self, data, timeout=DEFAULT_TIMEOUT, version=None, tags=None):
+		if self._async_client_cls is None:
+			return await super(RedisCache, self).aset_many(data, timeout, version, tags=tags)
+
+		if not data:
+			return
+
+		timeout = self.get_timeout(timeout)
+		tags = tags and await self.aget_tags_fingerprint(tags)
+		pipe = self.async_client.pipeline(transaction=False)
+		for key, value in data.items():
+			pipe.set(self.make_key(key, version, tags=tags), self.encode(value), timeout)
+		await pipe.execute()
+
+	@omit_exception
+	async def adelete(self, key, version=None, tags=None):
+		if self._async_client_cls is None:
+			return await super(RedisCache, self).adelete(key, version, tags=tags)
+
+		tags = tags and await self.aget_tags_fingerprint(tags)
+		return await self.async_client.delete(self.make_key(key, version, tags=tags))
+
+	@omit_exception
+	async def adelete_many(self, keys, version=None, tags=None):
+		if self._async_client_cls is None:
+			return await super(RedisCache, self).adelete_many(keys, version, tags=tags)
+
+		tags = tags and await self.aget_tags_fingerprint(tags)
+		keys = [self.make_key(k, version, tags=tags) for k in keys]
+		return await self.async_client.delete(*keys) if keys else 0
+
+	def alock(self, key, version=None, timeout=None, blocking_timeout=None):
+		if self._async_client_cls is None:
+			# acquire() and release() may run in different executor threads,
+			# so the lock's token must not be thread-local.
+			return AsyncLock(self, self.client.lock(self.make_key(key, version),
+						timeout=timeout,
+						blocking_timeout=blocking_timeout,
+						thread_local=False
+					))
+
+		return self.async_client.lock(self.make_key(key, version),
+					timeout=timeout,
+					blocking_timeout=blocking_timeout
+				)
@@ -0,0 +1,184 @@
+"Redis cache sharded over several locations with a consistent-hash ring."
+
+import hashlib
+from bisect import bisect, insort
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from flex.utils.module_loading import import_string
+from .base import BaseCache, DEFAULT_TIMEOUT
+
+
+class HashRing(object):
+	"""A consistent-hash ring with `replicas` virtual nodes per node.
+
+	Adding or removing one of N nodes only remaps about 1/N of the keys.
+	"""
+
+	def __init__(self, nodes=(), replicas=160):
+		self.replicas = replicas
+		self._points = []
+		self._nodes = {}
+		for node in nodes:
+			self.add(node)
+
+	@staticmethod
+	def hash(value):
+		return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+	def add(self, node):
+		for i in range(self.replicas):
+			point = self.hash('%s#%d' % (node, i))
+			self._nodes[point] = node
+			insort(self._points, point)
+
+	def remove(self, node):
+		for i in range(self.replicas):
+			point = self.hash('%s#%d' % (node, i))
+			if self._nodes.get(point) == node:
+				del self._nodes[point]
+				self._points.remove(point)
+
+	def get(self, key):
+		"""Return the node owning key."""
+		if not self._points:
+			raise LookupError('The hash ring is empty.')
+		pos = bisect(self._points, self.hash(key)) % len(self._points)
+		return self._nodes[self._points[pos]]
+
+	def __len__(self):
+		return len(set(self._nodes.values()))
+
+
+
+class ShardedRedisCache(BaseCache):
+	"""Spreads keys over several Redis locations.
+
+	`location` is a list of urls (or a string of urls separated by `;` or
+	`,`). Each key is routed to one location by a :class:`HashRing` of the
+	full cache keys. Multi-key operations send one batch per shard and the
+	shards are queried in parallel.
+
+	Extra options:
+		replicas: number of virtual nodes per location (default 160).
+		shard_backend: the backend used for each location
+			(default :class:`~flex.cache.backends.redis.RedisCache`).
+
+	All other options are passed to every shard. Tag generations are
+	sharded like any other key.
+	"""
+
+	def __init__(self, location, params):
+		super(ShardedRedisCache, self).__init__(params)
+		if isinstance(location, str):
+			location = location.replace(',', ';').split(';')
+		locations = [l.strip() for l in location if l.strip()]
+
+		params = dict(params)
+		replicas = int(params.pop('replicas', 160))
+		backend = params.pop('shard_backend', 'flex.cache.backends.redis.RedisCache')
+		backend_cls = import_string(backend) if isinstance(backend, str) else backend
+
+		self.shards = {url: backend_cls(url, params) for url in locations}
+		self.ring = HashRing(locations, replicas=replicas)
+		self._executor = ThreadPoolExecutor(max(1, len(locations)))
+
+	def get_shard(self, key, version=None, tags=None):
+		"""Return the backend holding the given key."""
+		return self.shards[self.ring.get(self.make_key(key, version, tags=tags))]
+
+	def _group(self, keys, version=None, tags=None):
+		rv = defaultdict(list)
+		for key in keys:
+			rv[self.ring.get(self.make_key(key, version, tags=tags))].append(key)
+		return rv
+
+	def _fan_out(self, calls):
+		"""Run the given (func, args) calls in parallel and return their
+		results in the same order.
+		"""
+		if len(calls) == 1:
+			func, args = calls[0]
+			return [func(*args)]
+		futures = [self._executor.submit(func, *args) for func, args in calls]
+		return [f.result() for f in futures]
+
+	def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None, tags=None):
+		tags = tags and self.get_tags_fingerprint(tags)
+		return self.get_shard(key, version, tags).add(key, value, timeout, version, tags)
+
+	def get(self, key, default=None, version=None, tags=None):
+		tags = tags and self.get_tags_fingerprint(tags)
+		rv = self.get_shard(key, version, tags).get(key, None, version, tags)
+		return default if rv is None else rv
+
+	def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None, tags=None):
+		tags = tags and self.get_tags_fingerprint(tags)
+		return self.get_shard(key, version, tags).set(key, value, timeout, version, tags)
+
+	def delete(self, key, version=None, tags=None):
+		tags = tags and self.get_tags_fingerprint(tags)
+		return self.get_shard(key, version, tags).delete(key, version, tags)
+
+	def has_key(self, key, version=None, tags=None):
+		tags = tags and self.get_tags_fingerprint(tags)
+		return self.get_shard(key, version, tags).has_key(key, version, tags)
+
+	def incr(self, key, delta=1, default=None, timeout=DEFAULT_TIMEOUT, version=None, tags=None):
+		tags = tags and self.get_tags_fingerprint(tags)
+		return self.get_shard(key, version, tags).incr(key, delta, default, timeout, version, tags)
+
+	def decr(self, key, delta=1, version=None, tags=None):
+		tags = tags and self.get_tags_fingerprint(tags)
+		return self.get_shard(key, version, tags).decr(key, delta, version, tags)
+
+	def ttl(self, key, version=None):
+		return self.get_shard(key, version).ttl(key, version)
+
+	def persist(self, key, version=None):
+		return self.get_shard(key, version).persist(key, version)
+
+	def expire(self, key, timeout, version=None):
+		return self.get_shard(key, version).expire(key, timeout, version)
+
+	def lock(self, key, version=None, timeout=None, blocking_timeout=None):
+		return self.get_shard(key, version).lock(key, version, timeout, blocking_timeout)
+
+	def get_many(self, keys, version=None, tags=None):
+		"""Fetch the keys with one batch per shard, from all shards in
+		parallel.
+		"""
+		tags = tags and self.get_tags_fingerprint(tags)
+		groups = self._group(keys, version, tags)
+		rv = {}
+		for found in self._fan_out([(self.shards[url].get_many, (keys, version, tags))
+									for url, keys in groups.items()]):
+			rv.update(found)
+		return rv
+
+	def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None, tags=None):
+		"""Set the values with one batch per shard, on all shards in
+		parallel.
+		"""
+		tags = tags and self.get_tags_fingerprint(tags)
+		groups = self._group(data, version, tags)
+		self._fan_out([(self.shards[url].set_many, ({k: data[k] for k in keys}, timeout, version, tags))
+						for url, keys in groups.items()])
+
+	def delete_many(self, keys, version=None, tags=None):
+		tags = tags and self.get_tags_fingerprint(tags)
+		groups = self._group(keys, version, tags)
+		return sum(rv or 0 for rv in self._fan_out([(self.shards[url].delete_many, (keys, version, tags))
+									for url, keys in groups.items()]))
+
+	def delete_pattern(self, pattern, version=None, count=None, batch_size=None):
+		"""Delete the keys matching pattern on all shards."""
+		return sum(rv or 0 for rv in self._fan_out([(shard.delete_pattern, (pattern, version, count, batch_size))
+									for shard in self.shards.values()]))
+
+	def clear(self):
+		self._fan_out([(shard.clear, ()) for shard in self.shards.values()])
+
+	def close(self, **kwargs):
+		for shard in self.shards.values():
+			shard.close(**kwargs)
@@ -0,0 +1,302 @@
+"Optional instrumentation layer for cache backends."
+
+import time
+from bisect import bisect_left
+from threading import Lock
+
+from .backends.base import DEFAULT_TIMEOUT
+from .signals import cache_stats
+
+
+__all__ = ['InstrumentedCache', 'Histogram']
+
+
+#: Upper bounds (in seconds) of the latency histogram buckets.
+LATENCY_BUCKETS = (
+	0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+	0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, float('inf')
+)
+
+#: Upper bounds (in bytes) of the value size histogram buckets.
+SIZE_BUCKETS = tuple(64 * 4 ** i for i in range(10)) + (float('inf'),)
+
+
+class Histogram(object):
+
+	__slots__ = ('buckets', 'counts', 'count', 'total', 'max')
+
+	def __init__(self, buckets):
+		self.buckets = buckets
+		self.counts = [0] * len(buckets)
+		self.count = 0
+		self.total = 0
+		self.max = 0
+
+	def add(self, value):
+		self.counts[bisect_left(self.buckets, value)] += 1
+		self.count += 1
+		self.total += value
+		if value > self.max:
+			self.max = value
+
+	def todict(self):
+		return dict(
+			count=self.count,
+			total=self.total,
+			max=self.max,
+			mean=self.count and self.total / self.count,
+			buckets=dict(zip(self.buckets, self.counts)),
+		)
+
+
+class InstrumentedCache(object):
+	"""Wraps a cache backend and records per-alias stats:
+
+	- hits, misses, sets and deletes per key prefix (the part of the key
+	  before the first `prefix_sep`).
+	- a latency histogram per operation.
+	- histograms of the encoded sizes of written and read values.
+
+	A snapshot is returned by :meth:`stats` and sent through the
+	:data:`~flex.cache.signals.cache_stats` signal at most every
+	`emit_interval` seconds (if set) and whenever :meth:`emit_stats` is
+	called.
+
+	Enabled per alias with the `instrument` option in `CACHES`, which can
+	be `True` or a dict of keyword arguments for this class.
+	"""
+
+	def __init__(self, backend, alias, prefix_sep=':', emit_interval=None):
+		self.backend = backend
+		self.alias = alias
+		self.prefix_sep = prefix_sep
+		self.emit_interval = emit_interval
+		self._lock = Lock()
+		self._last_emit = time.time()
+		self.reset_stats()
+		self._instrument_codec()
+
+	def _instrument_codec(self):
+		encode, decode = self.backend.encode, self.backend.decode
+
+		def measured_encode(value):
+			rv = encode(value)
+			self._record_size(self._write_sizes, rv)
+			return rv
+
+		def measured_decode(value):
+			self._record_size(self._read_sizes, value)
+			return decode(value)
+
+		self.backend.encode = measured_encode
+		self.backend.decode = measured_decode
+
+	def reset_stats(self):
+		with self._lock:
+			self._ops = {}
+			self._prefixes = {}
+			self._write_sizes = Histogram(SIZE_BUCKETS)
+			self._read_sizes = Histogram(SIZE_BUCKETS)
+
+	def stats(self):
+		"""Return a snapshot of the recorded stats."""
+		with self._lock:
+			prefixes = {}
+			for prefix, counts in self._prefixes.items():
+				counts = dict(counts)
+				lookups = counts['hits'] + counts['misses']
+				counts['hit_ratio'] = lookups and counts['hits'] / lookups
+				prefixes[prefix] = counts
+
+			rv = dict(
+				alias=self.alias,
+				prefixes=prefixes,
+				latency={op: h.todict() for op, h in self._ops.items()},
+				sizes=dict(write=self._write_sizes.todict(), read=self._read_sizes.todict()),
+			)
+
+		hits = sum(c['hits'] for c in prefixes.values())
+		lookups = hits + sum(c['misses'] for c in prefixes.values())
+		rv['hit_ratio'] = lookups and hits / lookups
+		backend_stats = getattr(self.backend, 'stats', None)
+		if callable(backend_stats):
+			rv['backend'] = backend_stats()
+		return rv
+
+	def emit_stats(self):
+		"""Send the current stats through the cache_stats signal."""
+		self._last_emit = time.time()
+		cache_stats.send(self, stats=self.stats())
+
+	def _prefix(self, key):
+		key = str(key)
+		return key.split(self.prefix_sep, 1)[0] if self.prefix_sep in key else ''
+
+	def _record(self, op, started, key=None, keys=(), **counts):
+		elapsed = time.perf_counter() - started
+		with self._lock:
+			hist = self._ops.get(op)
+			if hist is None:
+				hist = self._ops[op] = Histogram(LATENCY_BUCKETS)
+			hist.add(elapsed)
+			if counts:
+				for k in (keys if key is None else (key,)):
+					prefix = self._prefix(k)
+					pc = self._prefixes.get(prefix)
+					if pc is None:
+						pc = self._prefixes[prefix] = dict(hits=0, misses=0, sets=0, deletes=0)
+					for name, value in counts.items():
+						pc[name] += value(k) if callable(value) else value
+
+		if self.emit_interval and time.time() - self._last_emit >= self.emit_interval:
+			self.emit_stats()
+
+	def _record_size(self, hist, value):
+		try:
+			size = len(value)
+		except TypeError:
+			return
+		with self._lock:
+			hist.add(size)
+
+	def get(self, key, default=None, version=None, **kwargs):
+		started = time.perf_counter()
+		rv = self.backend.get(key, None, version=version, **kwargs)
+		hit = rv is not None
+		self._record('get', started, key, hits=int(hit), misses=int(not hit))
+		return rv if hit else default
+
+	def get_many(self, keys, version=None, **kwargs):
+		keys = list(keys)
+		started = time.perf_counter()
+		rv = self.backend.get_many(keys, version=version, **kwargs)
+		self._record('get_many', started, keys=keys,
+				hits=lambda k: int(k in rv), misses=lambda k: int(k not in rv))
+		return rv
+
+	def has_key(self, key, version=None, **kwargs):
+		started = time.perf_counter()
+		rv = self.backend.has_key(key, version=version, **kwargs)
+		self._record('has_key', started, key, hits=int(bool(rv)), misses=int(not rv))
+		return rv
+
+	def get_or_set(self, key, default, timeout=DEFAULT_TIMEOUT, version=None, **kwargs):
+		computed = []
+
+		def compute():
+			# The backend only calls this on a miss (or to recompute an
+			# expiring value), which is how misses are told from hits.
+			computed.append(True)
+			return default() if callable(default) else default
+
+		started = time.perf_counter()
+		rv = self.backend.get_or_set(key, None if default is None else compute,
+						timeout, version, **kwargs)
+		miss = bool(computed) or rv is None
+		self._record('get_or_set', started, key, hits=int(not miss), misses=int(miss),
+				sets=int(bool(computed)))
+		return rv
+
+	def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None, **kwargs):
+		started = time.perf_counter()
+		rv = self.backend.set(key, value, timeout, version, **kwargs)
+		self._record('set', started, key, sets=1)
+		return rv
+
+	def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None, **kwargs):
+		started = time.perf_counter()
+		rv = self.backend.add(key, value, timeout, version, **kwargs)
+		self._record('add', started, key, sets=int(bool(rv)))
+		return rv
+
+	def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None, **kwargs):
+		started = time.perf_counter()
+		rv = self.backend.set_many(data, timeout, version, **kwargs)
+		self._record('set_many', started, keys=data, sets=1)
+		return rv
+
+	def delete(self, key, version=None, **kwargs):
+		started = time.perf_counter()
+		rv = self.backend.delete(key, version, **kwargs)
+		self._record('delete', started, key, deletes=1)
+		return rv
+
+	def delete_many(self, keys, version=None, **kwargs):
+		keys = list(keys)
+		started = time.perf_counter()
+		rv = self.backend.delete_many(keys, version, **kwargs)
+		self._record('delete_many', started, keys=keys, deletes=1)
+		return rv
+
+	def incr(self, key, delta=1, *args, **kwargs):
+		started = time.perf_counter()
+		rv = self.backend.incr(key, delta, *args, **kwargs)
+		self._record('incr', started, key, sets=1)
+		return rv
+
+	def decr(self, key, delta=1, *args, **kwargs):
+		started = time.perf_counter()
+		rv = self.backend.decr(key, delta, *args, **kwargs)
+		self._record('decr', started, key, sets=1)
+		return rv
+
+	async def aget(self, key, default=None, version=None, **kwargs):
+		started = time.perf_counter()
+		rv = await self.backend.aget(key, None, version=version, **kwargs)
+		hit = rv is not None
+		self._record('aget', started, key, hits=int(hit), misses=int(not hit))
+		return rv if hit else default
+
+	async def aget_many(self, keys, version=None, **kwargs):
+		keys = list(keys)
+		started = time.perf_counter()
+		rv = await self.backend.aget_many(keys, version=version, **kwargs)
+		self._record('aget_many', started, keys=keys,
+				hits=lambda k: int(k in rv), misses=lambda k: int(k not in rv))
+		return rv
+
+	async def aset(self, key, value, timeout=DEFAULT_TIMEOUT, version=None, **kwargs):
+		started = time.perf_counter()
+		rv = await self.backend.aset(key, value, timeout, version, **kwargs)
+		self._record('aset', started, key, sets=1)
+		return rv
+
+	async def aadd(self, key, value, timeout=DEFAULT_TIMEOUT, version=None, **kwargs):
+		started = time.perf_counter()
+		rv = await self.backend.aadd(key, value, timeout, version, **kwargs)
+		self._record('aadd', started, key, sets=int(bool(rv)))
+		return rv
+
+	async def aset_many(self, data, timeout=DEFAULT_TIMEOUT, version=None, **kwargs):
+		started = time.perf_counter()
+		rv = await self.backend.aset_many(data, timeout, version, **kwargs)
+		self._record('aset_many', started, keys=data, sets=1)
+		return rv
+
+	async def adelete(self, key, version=None, **kwargs):
+		started = time.perf_counter()
+		rv = await self.backend.adelete(key, version, **kwargs)
+		self._record('adelete', started, key, deletes=1)
+		return rv
+
+	async def adelete_many(self, keys, version=None, **kwargs):
+		keys = list(keys)
+		started = time.perf_counter()
+		rv = await self.backend.adelete_many(keys, version, **kwargs)
+		self._record('adelete_many', started, keys=keys, deletes=1)
+		return rv
+
+	async def aincr(self, key, delta=1, *args, **kwargs):
+		started = time.perf_counter()
+		rv = await self.backend.aincr(key, delta, *args, **kwargs)
+		self._record('aincr', started, key, sets=1)
+		return rv
+
+	def __contains__(self, key):
+		return self.has_key(key)
+
+	def __getattr__(self, name):
+		return getattr(self.backend, name)
+
+	def __repr__(self):
+		return '<InstrumentedCache %r: %r>' % (self.alias, self.backend)
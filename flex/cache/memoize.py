@@ -0,0 +1,176 @@
+"Memoization of function calls in the cache."
+
+import hashlib
+import inspect
+from threading import Lock, Event
+from functools import update_wrapper
+
+from .backends.base import DEFAULT_TIMEOUT, MEMCACHE_MAX_KEY_LENGTH
+
+
+__all__ = ['memoize']
+
+
+class _Call(object):
+	"""A function call in progress that concurrent callers can wait for."""
+
+	__slots__ = ('event', 'result', 'exc')
+
+	def __init__(self):
+		self.event = Event()
+		self.result = None
+		self.exc = None
+
+
+class _MemoizedFunction(object):
+
+	def __init__(self, func, manager, timeout=DEFAULT_TIMEOUT, alias=None, version=None):
+		self.func = func
+		self.manager = manager
+		self.timeout = timeout
+		self.alias = alias
+		self.version = version
+		self.name = '%s.%s' % (func.__module__, getattr(func, '__qualname__', func.__name__))
+		self.tag = 'memoize:%s' % self.name
+		self.signature = inspect.signature(func)
+		self._calls = {}
+		self._lock = Lock()
+		update_wrapper(self, func)
+
+	@property
+	def cache(self):
+		return self.manager.backend() if self.alias is None else self.manager.backend(self.alias)
+
+	def make_key(self, *args, **kwargs):
+		"""Return the cache key for calling the function with the given
+		arguments. Arguments are bound to the function's signature, so calls
+		differing only in how arguments are passed share the same key.
+		Objects may define `__cache_key__()` to control their representation
+		and must do so if they don't define a `__repr__` of their own (see
+		:func:`memoize`).
+		"""
+		bound = self.signature.bind(*args, **kwargs)
+		bound.apply_defaults()
+		args = ','.join('%s=%s' % (k, _normalize(v)) for k, v in bound.arguments.items())
+		rv = '%s(%s)' % (self.name, args)
+		if len(rv) > MEMCACHE_MAX_KEY_LENGTH // 2 or any(ord(c) < 33 or ord(c) == 127 for c in rv):
+			rv = '%s(#%s)' % (self.name, hashlib.md5(args.encode('utf-8')).hexdigest())
+		return rv
+
+	def __call__(self, *args, **kwargs):
+		key = self.make_key(*args, **kwargs)
+		cache = self.cache
+		rv = cache.get(key, version=self.version, tags=(self.tag,))
+		if rv is not None:
+			return rv[0]
+
+		with self._lock:
+			call = self._calls.get(key)
+			leader = call is None
+			if leader:
+				call = self._calls[key] = _Call()
+
+		if not leader:
+			call.event.wait()
+			if call.exc is not None:
+				raise call.exc
+			return call.result
+
+		try:
+			call.result = self.func(*args, **kwargs)
+			cache.set(key, (call.result,), self.timeout, version=self.version, tags=(self.tag,))
+			return call.result
+		except Exception as e:
+			call.exc = e
+			raise
+		finally:
+			with self._lock:
+				del self._calls[key]
+			call.event.set()
+
+	def invalidate(self, *args, **kwargs):
+		"""Drop the memoized result for the given arguments."""
+		self.cache.delete(self.make_key(*args, **kwargs), version=self.version, tags=(self.tag,))
+
+	def invalidate_all(self):
+		"""Drop all memoized results of the function."""
+		self.cache.invalidate_tags(self.tag)
+
+	def __get__(self, obj, cls):
+		if obj is None:
+			return self
+		return _BoundMemoizedFunction(self, obj)
+
+	def __repr__(self):
+		return '<memoized %s>' % self.name
+
+
+class _BoundMemoizedFunction(object):
+
+	__slots__ = ('memoized', 'obj')
+
+	def __init__(self, memoized, obj):
+		self.memoized = memoized
+		self.obj = obj
+
+	def __call__(self, *args, **kwargs):
+		return self.memoized(self._check_instance(), *args, **kwargs)
+
+	def invalidate(self, *args, **kwargs):
+		return self.memoized.invalidate(self._check_instance(), *args, **kwargs)
+
+	def _check_instance(self):
+		if not hasattr(self.obj, '__cache_key__'):
+			raise TypeError(
+				'%r is a memoized method, so %s must define __cache_key__() '
+				'to identify its instances in cache keys.'
+				% (self.memoized, type(self.obj).__qualname__)
+			)
+		return self.obj
+
+	def invalidate_all(self):
+		return self.memoized.invalidate_all()
+
+	def __getattr__(self, name):
+		return getattr(self.memoized, name)
+
+
+def _normalize(value):
+	if hasattr(value, '__cache_key__'):
+		return value.__cache_key__()
+	elif isinstance(value, dict):
+		return '{%s}' % ','.join(sorted('%s:%s' % (_normalize(k), _normalize(v)) for k, v in value.items()))
+	elif isinstance(value, (set, frozenset)):
+		return '{%s}' % ','.join(sorted(_normalize(v) for v in value))
+	elif isinstance(value, (list, tuple)):
+		return '[%s]' % ','.join(_normalize(v) for v in value)
+	elif isinstance(value, type) or inspect.isfunction(value):
+		return '%s.%s' % (value.__module__, getattr(value, '__qualname__', value.__name__))
+	elif type(value).__repr__ is object.__repr__:
+		# The default repr holds the object's address, which differs between
+		# processes and may be reused by another object in this one.
+		raise TypeError(
+			'Cannot make a memoize cache key from %s objects. Define '
+			'__cache_key__() on the class.' % type(value).__qualname__
+		)
+	return repr(value)
+
+
+def memoize(manager, timeout=DEFAULT_TIMEOUT, alias=None, version=None):
+	"""Return a decorator that memoizes the results of the decorated function
+	in the `alias` cache of the given :class:`~flex.cache.CacheManager`.
+
+	The decorated function gets an `invalidate(*args, **kwargs)` method that
+	drops the result for the given arguments and an `invalidate_all()` method
+	that drops all results (via the function's cache tag). Concurrent calls
+	with the same arguments in the same process are coalesced into one.
+
+	Arguments are part of the cache key, so they must represent the same
+	value in every process. Objects are keyed by their `__cache_key__()`
+	method, else by their `repr()`; objects left with the default repr
+	(which holds their address) raise TypeError. Memoized methods require
+	`__cache_key__()` on their class, which keys the instance.
+	"""
+	def decorator(func):
+		return _MemoizedFunction(func, manager, timeout=timeout, alias=alias, version=version)
+	return decorator
@@ -0,0 +1,217 @@
+"""Cache value serializers and compression.
+
+Values encoded by a :class:`Codec` are prefixed with a one-byte header that
+records the serializer and the compressor used. The header's value is always
+below 0x10 so it can't be confused with the first byte of a raw pickle or JSON
+payload. Values without a header (e.g. ones stored by older versions) are
+decoded with the codec's legacy serializer (pickle by default).
+"""
+import json
+import lzma
+import zlib
+import pickle
+
+from flex.utils.module_loading import import_string
+
+try:
+	import msgpack
+	msgpack_available = True
+except ImportError:
+	msgpack_available = False
+
+
+__all__ = [
+	'BaseSerializer', 'PickleSerializer', 'JSONSerializer', 'MsgPackSerializer',
+	'Codec', 'get_serializer', 'SERIALIZERS', 'COMPRESSORS',
+]
+
+
+class BaseSerializer(object):
+	"""Base class for builtin serializers.
+
+	`serializer_id` is stored in the header of encoded values and must be
+	unique among the builtin serializers (1 to 3). 0 is reserved for custom
+	serializers.
+	"""
+	serializer_id = 0
+
+	def dumps(self, value):
+		raise NotImplementedError('subclasses of BaseSerializer must provide a dumps() method')
+
+	def loads(self, value):
+		raise NotImplementedError('subclasses of BaseSerializer must provide a loads() method')
+
+
+class PickleSerializer(BaseSerializer):
+	serializer_id = 1
+
+	def __init__(self, protocol=pickle.HIGHEST_PROTOCOL):
+		self.protocol = protocol
+
+	def dumps(self, value):
+		return pickle.dumps(value, self.protocol)
+
+	def loads(self, value):
+		return pickle.loads(value)
+
+
+class JSONSerializer(BaseSerializer):
+	serializer_id = 2
+
+	def __init__(self, encoder=None, decoder=None):
+		self.encoder = import_string(encoder) if isinstance(encoder, str) else encoder
+		self.decoder = import_string(decoder) if isinstance(decoder, str) else decoder
+
+	def dumps(self, value):
+		return json.dumps(value, cls=self.encoder, separators=(',', ':')).encode('utf-8')
+
+	def loads(self, value):
+		if not isinstance(value, str):
+			value = bytes(value).decode('utf-8')
+		return json.loads(value, cls=self.decoder)
+
+
+class MsgPackSerializer(BaseSerializer):
+	serializer_id = 3
+
+	def __init__(self):
+		if not msgpack_available:
+			raise RuntimeError('MsgPackSerializer requires msgpack to be installed.')
+
+	def dumps(self, value):
+		return msgpack.packb(value, use_bin_type=True)
+
+	def loads(self, value):
+		return msgpack.unpackb(value, raw=False)
+
+
+class _ZlibCompressor(object):
+	compressor_id = 1
+
+	def __init__(self, level=None):
+		self.level = 6 if level is None else level
+
+	def compress(self, value):
+		return zlib.compress(value, self.level)
+
+	def decompress(self, value):
+		return zlib.decompress(value)
+
+
+class _LzmaCompressor(object):
+	compressor_id = 2
+
+	def __init__(self, level=None):
+		self.level = level
+
+	def compress(self, value):
+		return lzma.compress(value, preset=self.level)
+
+	def decompress(self, value):
+		return lzma.decompress(value)
+
+
+SERIALIZERS = {
+	'pickle': PickleSerializer,
+	'json': JSONSerializer,
+	'msgpack': MsgPackSerializer,
+}
+
+COMPRESSORS = {
+	'zlib': _ZlibCompressor,
+	'lzma': _LzmaCompressor,
+}
+
+_HEADER_LIMIT = 0x10
+
+
+class Codec(object):
+	"""Serializes values with `serializer` and compresses the ones whose
+	serialized size is at least `min_size` bytes with `compressor` (if any).
+	"""
+
+	__slots__ = (
+		'serializer', 'compressor', 'min_size', 'legacy',
+		'_serializer_id', '_serializers', '_compressors'
+	)
+
+	def __init__(self, serializer, compressor=None, min_size=1024, level=None, legacy=pickle):
+		self.serializer = serializer
+		self._serializer_id = getattr(serializer, 'serializer_id', 0)
+		self.min_size = min_size
+		self.legacy = legacy
+
+		if isinstance(compressor, str):
+			try:
+				compressor = COMPRESSORS[compressor](level)
+			except KeyError:
+				raise ValueError('Unknown cache compressor %r.' % compressor)
+		self.compressor = compressor
+
+		self._serializers = {self._serializer_id: serializer}
+		self._compressors = {c.compressor_id: c for c in (compressor,) if c is not None}
+
+	def dumps(self, value):
+		rv = self.serializer.dumps(value)
+		cid = 0
+		if self.compressor is not None and len(rv) >= self.min_size:
+			compressed = self.compressor.compress(rv)
+			if len(compressed) < len(rv):
+				rv, cid = compressed, self.compressor.compressor_id
+		return bytes(((self._serializer_id << 2) | cid,)) + rv
+
+	def loads(self, value):
+		if not value or value[0] >= _HEADER_LIMIT:
+			return self.legacy.loads(value)
+
+		header, value = value[0], value[1:]
+		sid, cid = header >> 2, header & 3
+		if cid:
+			value = self._get_compressor(cid).decompress(value)
+		return self._get_serializer(sid).loads(value)
+
+	def _get_serializer(self, sid):
+		try:
+			return self._serializers[sid]
+		except KeyError:
+			for cls in SERIALIZERS.values():
+				if cls.serializer_id == sid:
+					rv = self._serializers[sid] = cls()
+					return rv
+			raise ValueError('Unknown cache serializer id %r.' % sid)
+
+	def _get_compressor(self, cid):
+		try:
+			return self._compressors[cid]
+		except KeyError:
+			for cls in COMPRESSORS.values():
+				if cls.compressor_id == cid:
+					rv = self._compressors[cid] = cls()
+					return rv
+			raise ValueError('Unknown cache compressor id %r.' % cid)
+
+
+
+def get_serializer(serializer, compressor=None, min_size=1024, level=None):
+	"""Return the serializer to use for cache values.
+
+	`serializer` can be the name of a builtin serializer ('pickle', 'json',
+	'msgpack'), a dotted import path or an object with `dumps()` and
+	`loads()` methods. Builtin serializers are wrapped in a :class:`Codec`.
+	Custom serializers are only wrapped if a compressor is given so that
+	values stored with them keep their current format.
+	"""
+	if not serializer:
+		return None
+	elif isinstance(serializer, str):
+		serializer = SERIALIZERS[serializer]() if serializer in SERIALIZERS \
+			else import_string(serializer)
+
+	if isinstance(serializer, type) and issubclass(serializer, BaseSerializer):
+		serializer = serializer()
+
+	if isinstance(serializer, BaseSerializer):
+		return Codec(serializer, compressor, min_size, level)
+	elif compressor:
+		return Codec(serializer, compressor, min_size, level, legacy=serializer)
+	return serializer
@@ -0,0 +1,7 @@
+from flex.signal import signals
+
+
+#: Sent by instrumented caches with a snapshot of their stats. The sender is
+#: the :class:`~flex.cache.instrumentation.InstrumentedCache` and the
+#: snapshot is passed as `stats`.
+cache_stats = signals.signal('cache.stats')
@@ -46,6 +46,18 @@ class LazyConfig(LazyObject):
 		self._wrapped.from_object(default_config)
 		self._wrapped.from_envvar(ENVIRONMENT_VARIABLE)
 
+	def __getattr__(self, name):
+		if self._wrapped is empty:
+			self._setup(name)
+		if name.isupper():
+			# Config keys aren't attributes. Skip the attribute lookup on the
+			# config that would fail before falling back to the key.
+			try:
+				return self._wrapped[name]
+			except KeyError:
+				pass
+		return getattr(self._wrapped, name)
+
 	def __repr__(self):
 		if self._wrapped is empty:
 			return '<LazyConfig [Unevaluated]>'
@@ -5,7 +5,7 @@ from importlib import import_module
 from threading import Lock
 from flask.config import ConfigAttribute
 from collections import namedtuple, Mapping
-from flex.datastructures import AttrDict, AttrChainMap
+from flex.datastructures import AttrDict, AttrChainMap, ChainMap
 
 
 from flex.utils.module_loading import import_string, import_strings
@@ -30,14 +30,21 @@ NOTHING = object()
 
 
 class LazyConfigVar(object):
+	"""A config value computed by `func(config)` when it's first needed.
 
-	__slots__ = ('_func', '_cached', '_config', '__name__', '_lock')
+	Cached vars are resolved once: the value is written back to the config
+	(replacing the proxy stored there) and later calls return it without
+	locking.
+	"""
+
+	__slots__ = ('_func', '_cached', '_config', '__name__', '_lock', '_value')
 
 	def __init__(self, func, cached=True, name=None, config=None):
 		self._func = func
 		self.__name__ = name or func.__name__
 		self._cached = cached
 		self._config = config
+		self._value = NOTHING
 		if self._cached and self._config is not None:
 			self._lock = Lock()
 
@@ -50,15 +57,24 @@ class LazyConfigVar(object):
 	def proxy(self, config=None, name=None, cached=None):
 		return Proxy(self.clone(config=config, name=name, cached=cached))
 
+	@property
+	def resolved(self):
+		return self._value is not NOTHING
+
 	def __call__(self, *args, **kwargs):
-		if self._cached and self._config is not None:
-			with self._lock:
-				rv = self._func(self._config, *args, **kwargs)
-				self._config[self.__name__] = rv
-				return rv
-		else:
+		if not (self._cached and self._config is not None):
 			return self._func(self._config, *args, **kwargs)
 
+		rv = self._value
+		if rv is NOTHING:
+			with self._lock:
+				rv = self._value
+				if rv is NOTHING:
+					rv = self._func(self._config, *args, **kwargs)
+					self._value = rv
+					self._config[self.__name__] = rv
+		return rv
+
 
 def lazy(*func, cached=True, name=None):
 	def wrapped(fn):
@@ -75,18 +91,57 @@ def lazy_import(value, name=None, package=None, silent=False):
 
 class Config(AttrChainMap):
 
-	__slots__ = 'root_path',
+	__slots__ = 'root_path', '_snapshot', '_namespaces', '_lazy_vars',
+
+	#: Incremented on every write to any config. Compiled snapshots older
+	#: than the current version are stale.
+	version = 0
 
 	def __init__(self, root_path, *bases):
 		super(Config, self).__init__(*bases)
+		self.setattr('_snapshot', None)
+		self.setattr('_namespaces', {})
+		self.setattr('_lazy_vars', {})
 		self.setattr('root_path', root_path)
 		self.setdefault('bootstrapped', False)
 
 	def bootstrap(self):
-		for k in self:
-			v = str(self.get(k))
+		self.resolve_all()
 		self.bootstrapped = True
 
+	def resolve_all(self):
+		"""Resolve the cached lazy values (see :func:`lazy`) of this config
+		and of the configs it's chained to, replacing their proxies with the
+		values. Called by :meth:`bootstrap`. Pre-fork servers can call it
+		before forking so that the values are computed once.
+		"""
+		self._resolve_lazy_vars()
+		for m in self.maps[1:]:
+			if isinstance(m, Config):
+				m.resolve_all()
+
+	def _resolve_lazy_vars(self):
+		for key, proxy in list(self._lazy_vars.items()):
+			proxy._get_current_object()
+
+	def compile(self):
+		"""Compile a flattened snapshot of the config (and of its namespaces).
+		From then on lookups are plain dict lookups instead of walks down the
+		chain of maps. Any write to a config makes the snapshot stale and it
+		is recompiled on the next lookup. Called by :meth:`Kernel.bootstrap`.
+		"""
+		self._compile_snapshot()
+		for ns in list(self._namespaces.values()):
+			ns.compile()
+
+	def _compile_snapshot(self):
+		if self._lazy_vars:
+			self._resolve_lazy_vars()
+		version = Config.version
+		rv = version, {k: ChainMap.__getitem__(self, k) for k in ChainMap.__iter__(self)}
+		self.setattr('_snapshot', rv)
+		return rv
+
 	def from_envvar(self, variable_name, silent=False):
 		"""Loads a configuration from an environment variable pointing to
 		a configuration file.  This is basically just a shortcut with nicer
@@ -290,11 +345,18 @@ class Config(AttrChainMap):
 						  dictionary should not include the namespace
 
 		.. versionadded:: 0.11
+
+		The namespace configs are memoized. They are views, so they always
+		reflect the current values.
 		"""
-		return Config(
-				self.root_path,
-				self.get_namespace_view(namespace, lowercase, trim_namespace)
-			)
+		key = namespace, lowercase, trim_namespace
+		rv = self._namespaces.get(key)
+		if rv is None:
+			rv = Config(self.root_path, self.get_namespace_view(*key))
+			if self._snapshot is not None:
+				rv.compile()
+			rv = self._namespaces.setdefault(key, rv)
+		return rv
 
 	def get_namespace(self, namespace, lowercase=True, trim_namespace=True):
 		"""Returns a dictionary containing a subset of configuration options
@@ -337,10 +399,62 @@ class Config(AttrChainMap):
 				)
 			)
 
+	def __getitem__(self, key, *args):
+		snapshot = self._snapshot
+		if snapshot is not None and not args and not isinstance(key, slice):
+			if snapshot[0] != Config.version:
+				snapshot = self._compile_snapshot()
+			try:
+				return snapshot[1][key]
+			except KeyError:
+				raise KeyError("Key '%s' not found in any mapping." % (key,)) from None
+
+		rv = super(Config, self).__getitem__(key, *args)
+		if self._lazy_vars and not args and not isinstance(key, slice) \
+				and self._lazy_vars.get(key, NOTHING) is rv:
+			# Resolved on first access so that the proxy is never returned.
+			rv = rv._get_current_object()
+		return rv
+
+	def __contains__(self, key):
+		snapshot = self._snapshot
+		if snapshot is not None:
+			if snapshot[0] != Config.version:
+				snapshot = self._compile_snapshot()
+			return key in snapshot[1]
+		return super(Config, self).__contains__(key)
+
+	def __iter__(self):
+		snapshot = self._snapshot
+		if snapshot is not None:
+			if snapshot[0] != Config.version:
+				snapshot = self._compile_snapshot()
+			return iter(list(snapshot[1]))
+		return super(Config, self).__iter__()
+
+	def __len__(self):
+		snapshot = self._snapshot
+		if snapshot is not None:
+			if snapshot[0] != Config.version:
+				snapshot = self._compile_snapshot()
+			return len(snapshot[1])
+		return super(Config, self).__len__()
+
 	def __setitem__(self, key, value):
 		if isinstance(value, LazyConfigVar):
+			cached = value._cached
 			value = value.proxy(self, name=key)
+			if cached:
+				self._lazy_vars[key] = value
+		else:
+			self._lazy_vars.pop(key, None)
 		super(Config, self).__setitem__(key, value)
+		Config.version += 1
+
+	def __delitem__(self, key):
+		super(Config, self).__delitem__(key)
+		self._lazy_vars.pop(key, None)
+		Config.version += 1
 
 
 
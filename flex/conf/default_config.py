@@ -43,6 +43,7 @@ SESSION_COOKIE_PATH = None
 SESSION_COOKIE_HTTPONLY = True
 SESSION_COOKIE_SECURE = False
 SESSION_REFRESH_EACH_REQUEST = True
+SESSION_REFRESH_WINDOW = timedelta(seconds=60)
 
 
 MAX_CONTENT_LENGTH =  None
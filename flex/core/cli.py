@@ -7,6 +7,7 @@ from datetime import datetime
 from flex.carbon import carbon
 from . import signals
 from flask import current_app
+from flex.signal import profiler
 
 
 __all__ = (
@@ -81,3 +82,31 @@ def install_command(addons=''):
 		signals.install.send(addon, addon=obj, app=current_app._get_current_object())
 		signals.install.send(obj, app=current_app._get_current_object())
 		print('')
+
+
+def signals_command(path=None, requests='1', by='receiver', sort='total', limit='30'):
+	"""Prints the signal receiver timings recorded by flex.signal.profiler. With
+	--path, the given number of --requests are first sent to path with the
+	test client. Set FLEX_PROFILE_SIGNALS to include the boot signals.
+	"""
+	if path:
+		enabled = profiler.enabled
+		profiler.enable()
+		client = current_app.test_client()
+		try:
+			for _ in range(int(requests)):
+				client.get(path)
+		finally:
+			profiler.enabled = enabled
+
+	rows = profiler.stats(by=by, sort=sort)[:int(limit)]
+	if not rows:
+		print('No signals recorded. Profiling is %s.' % ('on' if profiler.enabled else 'off'))
+		return
+
+	name = lambda r: r['signal'] if by == 'signal' else '%s -> %s' % (r['signal'], r['receiver'])
+	width = min(max(len(name(r)) for r in rows), 100)
+	print('%-*s %8s %12s %10s %10s' % (width, by, 'calls', 'total (ms)', 'mean (ms)', 'max (ms)'))
+	for r in rows:
+		print('%-*s %8d %12.2f %10.3f %10.3f' % (width, name(r)[:width], r['calls'],
+			r['total'] * 1000, r['mean'] * 1000, r['max'] * 1000))
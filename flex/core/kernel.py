@@ -15,7 +15,8 @@ from flex.utils.decorators import locked_cached_property
 from flex.utils.module_loading import import_string, import_strings
 
 from . import signals
-from .cli import Manager, Shell, Server, install_command
+from .cli import Manager, Shell, Server, install_command, signals_command
+from .session_cli import console as session_console
 from .sessions import SecureCookieSessionInterface
 from .exc import ImproperlyConfigured
 
@@ -95,6 +96,8 @@ class Kernel(Flask):
 			rv.add_command("start", Server(host=self.config.HOST, port=self.config.PORT))
 			rv.add_command("shell", Shell())
 			rv.command(install_command, name="install")
+			rv.command(signals_command, name="signals")
+			rv.add_command("session", session_console)
 			return rv
 
 	@locked_cached_property
@@ -112,6 +115,9 @@ class Kernel(Flask):
 		self.config.bootstrap()
 		self.init_default_addons()
 		self.init_configured_addons()
+		# Hot path config lookups become plain dict lookups.
+		global_config.compile()
+		self.config.compile()
 		self._has_booted = True
 		signals.app_booted.send(self)
 
@@ -291,7 +297,7 @@ class Kernel(Flask):
 
 	@postboot_method
 	def test_client(self, use_cookies=True, **kwargs):
-		return super(Kernel, self).test_client(host, port, debug, **options)
+		return super(Kernel, self).test_client(use_cookies, **kwargs)
 
 	@postboot_method
 	def test_request_context(self, *args, **kwargs):
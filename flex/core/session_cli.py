@@ -0,0 +1,129 @@
+import time
+from datetime import datetime
+from flask import current_app
+from .cli import Manager
+from .sessions import RedisSessionInterface
+
+
+
+console = Manager(usage="Inspect and clean up the sessions stored in redis.")
+
+
+#: Upper bounds (in bytes) of the size histogram buckets.
+SIZE_BUCKETS = (256, 512, 1024, 2048, 4096, 8192, 16384, 32768, 65536, 131072)
+
+
+@console.command
+def report(batch='1000', top='10', pause='0'):
+	"""Prints a histogram of stored session sizes and the largest sessions."""
+	si = _session_interface()
+	redis = si.get_redis(current_app)
+	top, hist, total, count, persistent = int(top), [0] * (len(SIZE_BUCKETS) + 1), 0, 0, 0
+	largest = []
+	for keys in _scan(si, batch, pause):
+		pipe = redis.pipeline(transaction=False)
+		for key in keys:
+			pipe.ttl(key)
+		ttls = pipe.execute()
+
+		for key, size, ttl in zip(keys, si.get_sizes(current_app, keys), ttls):
+			if not size:
+				continue
+			count += 1
+			total += size
+			# Keys without a ttl (-1) are never expired by redis.
+			persistent += ttl is not None and ttl < 0
+			hist[_bucket(size)] += 1
+			largest.append((size, key))
+		largest = sorted(largest, reverse=True)[:top]
+
+	print('Sessions:', count, ' Total size:', _format_size(total),
+		' Average:', _format_size(count and total // count),
+		' Without expiry:', persistent)
+	print('')
+
+	peak = max(hist) or 1
+	lower = 0
+	for upper, n in zip(SIZE_BUCKETS + (None,), hist):
+		label = '%s - %s' % (_format_size(lower), _format_size(upper)) if upper else '> %s' % _format_size(lower)
+		print('%-20s %8d  %s' % (label, n, '#' * int(round(n / peak * 60))))
+		lower = upper
+
+	if largest:
+		print('')
+		print('Largest sessions:')
+		for size, key in largest:
+			print('%10s  %s' % (_format_size(size), _decode(key)))
+
+
+@console.command
+def purge(batch='1000', dry_run=False, pause='0'):
+	"""Deletes the sessions last updated longer than SESSION_DATA_LIFESPAN ago."""
+	si = _session_interface()
+	lifespan = si.get_session_data_lifespan(current_app)
+	cutoff = datetime.now() - lifespan
+	found = deleted = 0
+	for keys in _scan(si, batch, pause):
+		updated = si.get_last_updated(current_app, keys)
+		stale = [k for k, u in zip(keys, updated) if isinstance(u, datetime) and u < cutoff]
+		found += len(stale)
+		if stale and not dry_run:
+			deleted += si.delete_keys(current_app, stale)
+
+	print('Sessions older than %s:' % lifespan, found)
+	if not dry_run:
+		print('Deleted:', deleted)
+
+
+@console.command
+def drop(users, key='user_id', batch='1000', pause='0'):
+	"""Deletes all the sessions of the given (comma separated) users. Users
+	are matched on the value of the session data key given by --key.
+	"""
+	si = _session_interface()
+	users = set(u.strip() for u in users.split(',') if u.strip())
+	deleted = 0
+	for keys in _scan(si, batch, pause):
+		values = si.get_data_values(current_app, keys, key)
+		matched = [k for k, v in zip(keys, values) if v is not None and str(v) in users]
+		deleted += si.delete_keys(current_app, matched)
+
+	print('Deleted sessions:', deleted)
+
+
+def _session_interface(app=None):
+	rv = (app or current_app).session_interface
+	if not isinstance(rv, RedisSessionInterface):
+		raise RuntimeError('The session commands require a RedisSessionInterface.')
+	return rv
+
+
+def _scan(si, batch, pause):
+	"""Yield batches of session keys, sleeping `pause` seconds between them
+	to spread the load on busy servers.
+	"""
+	pause = float(pause)
+	for i, keys in enumerate(si.scan_keys(current_app, int(batch))):
+		if i and pause:
+			time.sleep(pause)
+		yield keys
+
+
+def _bucket(size):
+	for i, upper in enumerate(SIZE_BUCKETS):
+		if size <= upper:
+			return i
+	return len(SIZE_BUCKETS)
+
+
+def _format_size(size):
+	if size is None:
+		return ''
+	for unit in ('B', 'KB', 'MB'):
+		if size < 1024 or unit == 'MB':
+			return '%d%s' % (size, unit) if unit == 'B' else '%.1f%s' % (size, unit)
+		size /= 1024
+
+
+def _decode(key):
+	return key.decode('utf-8', 'replace') if isinstance(key, bytes) else key
@@ -0,0 +1,284 @@
+"""Compact session serialization.
+
+Sessions are encoded with msgpack when it's installed (msgpack >= 1.0, the
+`msgpack` extra) and otherwise with a tight JSON format. Both support sets,
+tuples, bytes, datetimes and timedeltas through typed extensions. Any other
+value is pickled into a tagged extension, so whatever pickle could store
+still can be. Encoded
+sessions start with a one-byte header naming the format. Values without a
+header (i.e. sessions pickled by older versions) are decoded with the
+codec's legacy serializer (pickle by default).
+"""
+import json
+import time
+import pickle
+import struct
+from base64 import b64encode, b64decode
+from threading import local
+from datetime import datetime, timedelta
+
+try:
+	import msgpack
+except ImportError:
+	msgpack = None
+
+# The packer and unpacker options used here were added in msgpack 1.0.
+msgpack_available = msgpack is not None and msgpack.version >= (1, 0)
+
+
+__all__ = [
+	'SessionCodec', 'MsgPackSessionFormat', 'JSONSessionFormat', 'FORMATS',
+	'benchmark',
+]
+
+
+_EPOCH = datetime(1970, 1, 1)
+
+_int64 = struct.Struct('!q')
+
+
+def _microseconds(delta):
+	return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def _sorted(values, encode):
+	# Sets are encoded in sorted order so that equal sets always encode to
+	# the same bytes (their iteration order depends on hashing, which differs
+	# between processes). Values that can't be compared are ordered by their
+	# encoding.
+	try:
+		return sorted(values)
+	except TypeError:
+		return sorted(values, key=encode)
+
+
+def _pickle(obj):
+	return pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+
+
+class MsgPackSessionFormat(object):
+	"""msgpack with extension types for sets, tuples, datetimes and
+	timedeltas. Naive datetimes and timedeltas are packed as 8-byte
+	microsecond counts. Other types are pickled.
+	"""
+	format_id = 1
+
+	EXT_SET = 1
+	EXT_TUPLE = 2
+	EXT_DATETIME = 3
+	EXT_AWARE_DATETIME = 4
+	EXT_TIMEDELTA = 5
+	EXT_PICKLE = 6
+
+	def __init__(self):
+		if not msgpack_available:
+			raise RuntimeError(
+				'MsgPackSessionFormat requires msgpack >= 1.0 (found %s). '
+				'Install it with `pip install "msgpack>=1.0"` or use the '
+				'\'json\' session format.' % (
+					'.'.join(map(str, msgpack.version)) if msgpack else 'none',)
+			)
+		self._local = local()
+
+	def _default(self, obj):
+		if isinstance(obj, set):
+			return msgpack.ExtType(self.EXT_SET, self._pack_nested(_sorted(obj, self._pack_nested)))
+		elif isinstance(obj, datetime):
+			if obj.tzinfo is None:
+				return msgpack.ExtType(self.EXT_DATETIME, _int64.pack(_microseconds(obj - _EPOCH)))
+			return msgpack.ExtType(self.EXT_AWARE_DATETIME, obj.isoformat().encode('ascii'))
+		elif isinstance(obj, timedelta):
+			return msgpack.ExtType(self.EXT_TIMEDELTA, _int64.pack(_microseconds(obj)))
+		elif isinstance(obj, tuple):
+			return msgpack.ExtType(self.EXT_TUPLE, self._pack_nested(list(obj)))
+		for base in (dict, list, str, bytes, int, float):
+			# Subclasses of the native types (types are checked strictly so
+			# that tuples aren't packed as lists).
+			if isinstance(obj, base):
+				return base(obj)
+		return msgpack.ExtType(self.EXT_PICKLE, _pickle(obj))
+
+	def _pack_nested(self, value):
+		# The payload of extension types. The thread's packer can't be used
+		# here as it's busy packing the outer value.
+		return msgpack.packb(value, default=self._default, use_bin_type=True,
+					strict_types=True, datetime=False)
+
+	def _ext_hook(self, code, data):
+		if code == self.EXT_SET:
+			return set(self.loads(data))
+		elif code == self.EXT_TUPLE:
+			return tuple(self.loads(data))
+		elif code == self.EXT_DATETIME:
+			return _EPOCH + timedelta(microseconds=_int64.unpack(data)[0])
+		elif code == self.EXT_AWARE_DATETIME:
+			return datetime.fromisoformat(data.decode('ascii'))
+		elif code == self.EXT_TIMEDELTA:
+			return timedelta(microseconds=_int64.unpack(data)[0])
+		elif code == self.EXT_PICKLE:
+			return pickle.loads(data)
+		return msgpack.ExtType(code, data)
+
+	def dumps(self, value):
+		# Packers are reused (one per thread) as creating them is costly.
+		try:
+			packer = self._local.packer
+		except AttributeError:
+			packer = self._local.packer = msgpack.Packer(default=self._default,
+						use_bin_type=True, strict_types=True, datetime=False)
+		return packer.pack(value)
+
+	def loads(self, value):
+		return msgpack.unpackb(value, ext_hook=self._ext_hook, raw=False,
+					strict_map_key=False)
+
+
+class JSONSessionFormat(object):
+	"""Compact JSON. Values JSON can't represent are tagged as single-key
+	objects whose key starts with a space, like Flask's tagged JSON. Dicts
+	with non-string keys are stored as lists of pairs and values of types
+	without a tag are pickled.
+	"""
+	format_id = 2
+
+	def _tag(self, value):
+		if isinstance(value, dict):
+			if not all(isinstance(k, str) for k in value):
+				# JSON would turn the keys into strings.
+				return {' dk': [[self._tag(k), self._tag(v)] for k, v in value.items()]}
+			rv = {k: self._tag(v) for k, v in value.items()}
+			if len(rv) == 1 and next(iter(rv))[:1] == ' ':
+				# A dict that would pass as a tag.
+				return {' di': next(iter(rv.items()))}
+			return rv
+		elif isinstance(value, list):
+			return [self._tag(v) for v in value]
+		elif isinstance(value, tuple):
+			return {' t': [self._tag(v) for v in value]}
+		elif isinstance(value, set):
+			return {' s': [self._tag(v) for v in _sorted(value, self.dumps)]}
+		elif isinstance(value, datetime):
+			if value.tzinfo is None:
+				return {' d': _microseconds(value - _EPOCH)}
+			return {' a': value.isoformat()}
+		elif isinstance(value, timedelta):
+			return {' td': _microseconds(value)}
+		elif isinstance(value, bytes):
+			return {' b': b64encode(value).decode('ascii')}
+		elif value is None or isinstance(value, (str, int, float)):
+			return value
+		return {' p': b64encode(_pickle(value)).decode('ascii')}
+
+	def _untag(self, obj):
+		if len(obj) == 1:
+			key, value = next(iter(obj.items()))
+			if key == ' t':
+				return tuple(value)
+			elif key == ' s':
+				return set(value)
+			elif key == ' d':
+				return _EPOCH + timedelta(microseconds=value)
+			elif key == ' a':
+				return datetime.fromisoformat(value)
+			elif key == ' td':
+				return timedelta(microseconds=value)
+			elif key == ' b':
+				return b64decode(value)
+			elif key == ' di':
+				return {value[0]: value[1]}
+			elif key == ' dk':
+				return {k: v for k, v in value}
+			elif key == ' p':
+				return pickle.loads(b64decode(value))
+		return obj
+
+	def dumps(self, value):
+		return json.dumps(self._tag(value), separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+	def loads(self, value):
+		if not isinstance(value, str):
+			value = bytes(value).decode('utf-8')
+		return json.loads(value, object_hook=self._untag)
+
+
+FORMATS = {
+	'msgpack': MsgPackSessionFormat,
+	'json': JSONSessionFormat,
+}
+
+
+class SessionCodec(object):
+	"""Encodes sessions with the given format ('msgpack', 'json' or None to
+	use msgpack if msgpack >= 1.0 is installed and JSON otherwise). Sessions
+	in any of the formats can be decoded. Values without a format header are
+	decoded with `legacy` (pickle by default). Set `legacy` to None to refuse
+	them.
+
+	A codec can be used as the `redis_serializer` of
+	:class:`~flex.core.sessions.RedisSessionInterface`.
+	"""
+
+	__slots__ = ('format', 'legacy', '_header', '_formats')
+
+	def __init__(self, format=None, legacy=pickle):
+		if format is None:
+			format = 'msgpack' if msgpack_available else 'json'
+		if isinstance(format, str):
+			try:
+				format = FORMATS[format]()
+			except KeyError:
+				raise ValueError('Unknown session format %r.' % format)
+
+		self.format = format
+		self.legacy = legacy
+		self._header = bytes((format.format_id,))
+		self._formats = {format.format_id: format}
+
+	def dumps(self, value):
+		return self._header + self.format.dumps(value)
+
+	def loads(self, value):
+		fid = value[0] if value else None
+		fmt = self._formats.get(fid)
+		if fmt is None:
+			for cls in FORMATS.values():
+				if cls.format_id == fid:
+					fmt = self._formats[fid] = cls()
+					break
+			else:
+				if self.legacy is None:
+					raise ValueError('Unknown session format.')
+				return self.legacy.loads(value)
+		return fmt.loads(value[1:])
+
+
+def benchmark(session, number=10000, codecs=None):
+	"""Compare the encoded size and the encoding and decoding times (in
+	microseconds per call) of `session` (a dict as stored by a session
+	interface) for pickle and each available session format.
+	"""
+	if codecs is None:
+		codecs = dict(pickle=pickle)
+		for name in FORMATS:
+			if name != 'msgpack' or msgpack_available:
+				codecs[name] = SessionCodec(name)
+
+	rv = {}
+	for name, codec in codecs.items():
+		encoded = codec.dumps(session)
+		started = time.perf_counter()
+		for _ in range(number):
+			codec.dumps(session)
+		dumps_time = time.perf_counter() - started
+
+		started = time.perf_counter()
+		for _ in range(number):
+			codec.loads(encoded)
+		loads_time = time.perf_counter() - started
+
+		rv[name] = dict(
+			size=len(encoded),
+			dumps=dumps_time / number * 1e6,
+			loads=loads_time / number * 1e6,
+		)
+	return rv
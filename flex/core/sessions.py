@@ -1,6 +1,6 @@
-import pickle
 from . import exc, signals
 from uuid import uuid4
+from functools import partial
 from datetime import timedelta, datetime
 from werkzeug.datastructures import CallbackDict
 from flask.sessions import SessionMixin
@@ -10,9 +10,12 @@ from flask.sessions import (
 	SecureCookieSessionInterface as BaseCookieInterface, BadSignature
 )
 from warnings import warn
+from flex.redis import get_client as get_redis_client
+from .session_codecs import SessionCodec
 
 try:
 	from redis import Redis
+	from redis.exceptions import ResponseError
 	redis_available=True
 except ImportError:
 	redis_available = False
@@ -21,6 +24,245 @@ NOTHING = object()
 
 REPLACEABLE_TYPES = (type(None), str, int, float, bool)
 
+
+def track(value, on_update):
+	"""Return value with plain dicts, lists and sets (at any depth) replaced
+	by copies that call `on_update` when they change. Other values are
+	returned as is.
+	"""
+	tp = type(value)
+	if tp is dict:
+		return TrackedDict(value, on_update)
+	elif tp is list:
+		return CallbackList(value, on_update)
+	elif tp is set:
+		return CallbackSet(value, on_update)
+	return value
+
+
+class _Tracked(object):
+	"""Base of the containers returned by :func:`track`. Containers nested in
+	them are tracked too and report their changes through their parent.
+	They pickle as their plain counterparts.
+	"""
+	__slots__ = ()
+
+	def _changed(self):
+		if self.on_update is not None:
+			self.on_update(self)
+
+	def _nested_changed(self, value):
+		self._changed()
+
+	def _track(self, value):
+		return track(value, self._nested_changed)
+
+	def __reduce_ex__(self, protocol):
+		return self._plain_type, (self._plain_type(self),)
+
+
+class CallbackSet(_Tracked, set):
+	"""A set that calls `on_update` every time it's changed."""
+
+	__slots__ = ('on_update',)
+	_plain_type = set
+
+	def __init__(self, initial=None, on_update=None):
+		set.__init__(self, initial or ())
+		self.on_update = on_update
+
+	def add(self, value):
+		if value not in self:
+			set.add(self, value)
+			self._changed()
+
+	def discard(self, value):
+		if value in self:
+			set.discard(self, value)
+			self._changed()
+
+	def _calls_update(name):
+		method = getattr(set, name)
+		def oncall(self, *args):
+			size = len(self)
+			rv = method(self, *args)
+			if name == 'update' or len(self) != size:
+				self._changed()
+			return rv
+		oncall.__name__ = name
+		return oncall
+
+	remove = _calls_update('remove')
+	pop = _calls_update('pop')
+	clear = _calls_update('clear')
+	update = _calls_update('update')
+	difference_update = _calls_update('difference_update')
+	intersection_update = _calls_update('intersection_update')
+	symmetric_difference_update = _calls_update('symmetric_difference_update')
+	__ior__ = _calls_update('__ior__')
+	__iand__ = _calls_update('__iand__')
+	__isub__ = _calls_update('__isub__')
+	__ixor__ = _calls_update('__ixor__')
+	del _calls_update
+
+
+class CallbackList(_Tracked, list):
+	"""A list that calls `on_update` every time it's changed."""
+
+	__slots__ = ('on_update',)
+	_plain_type = list
+
+	def __init__(self, initial=None, on_update=None):
+		list.__init__(self, (self._track(v) for v in initial or ()))
+		self.on_update = on_update
+
+	def __setitem__(self, index, value):
+		if isinstance(index, slice):
+			value = [self._track(v) for v in value]
+		else:
+			value = self._track(value)
+		list.__setitem__(self, index, value)
+		self._changed()
+
+	def append(self, value):
+		list.append(self, self._track(value))
+		self._changed()
+
+	def insert(self, index, value):
+		list.insert(self, index, self._track(value))
+		self._changed()
+
+	def extend(self, values):
+		list.extend(self, [self._track(v) for v in values])
+		self._changed()
+
+	def __iadd__(self, values):
+		self.extend(values)
+		return self
+
+	def _calls_update(name):
+		method = getattr(list, name)
+		def oncall(self, *args, **kwargs):
+			rv = method(self, *args, **kwargs)
+			self._changed()
+			return rv
+		oncall.__name__ = name
+		return oncall
+
+	__delitem__ = _calls_update('__delitem__')
+	__imul__ = _calls_update('__imul__')
+	pop = _calls_update('pop')
+	remove = _calls_update('remove')
+	clear = _calls_update('clear')
+	sort = _calls_update('sort')
+	reverse = _calls_update('reverse')
+	del _calls_update
+
+
+class TrackedDict(_Tracked, CallbackDict):
+	"""A :class:`~werkzeug.datastructures.CallbackDict` whose nested dicts,
+	lists and sets are tracked too (see :func:`track`).
+	"""
+	_plain_type = dict
+
+	def __init__(self, initial=None, on_update=None):
+		super(TrackedDict, self).__init__(None, on_update)
+		for key, value in dict(initial or ()).items():
+			dict.__setitem__(self, key, self._track(value))
+
+	def __setitem__(self, key, value):
+		super(TrackedDict, self).__setitem__(key, self._track(value))
+
+	def setdefault(self, key, default=None):
+		return super(TrackedDict, self).setdefault(key, self._track(default))
+
+	def update(self, *args, **kwargs):
+		super(TrackedDict, self).update({k: self._track(v) for k, v in dict(*args, **kwargs).items()})
+
+
+NOT_LOADED = object()
+
+
+class HashSessionData(TrackedDict):
+	"""Session data read from a session's redis hash.
+
+	Values that are still :data:`NOT_LOADED` are fetched with `loader(keys)`
+	on first access. `stored` maps the hash fields read from redis to their
+	raw values (None if not fetched yet) so that only changed fields need to
+	be written back.
+	"""
+
+	def __init__(self, initial=None, on_update=None, loader=None, stored=None):
+		super(HashSessionData, self).__init__(initial, on_update)
+		self.loader = loader
+		self.stored = stored
+
+	def load(self, keys=None):
+		"""Fetch the values of the given keys (all keys by default) that are
+		not loaded yet.
+		"""
+		keys = [k for k in (self.keys() if keys is None else keys)
+					if dict.get(self, k) is NOT_LOADED]
+		if keys:
+			values = self.loader(keys)
+			for key in keys:
+				if key in values:
+					dict.__setitem__(self, key, self._track(values[key]))
+				else:
+					dict.pop(self, key, None)
+
+	def __getitem__(self, key):
+		self.load((key,))
+		return dict.__getitem__(self, key)
+
+	def __iter__(self):
+		self.load()
+		return dict.__iter__(self)
+
+	def get(self, key, default=None):
+		self.load((key,))
+		return dict.get(self, key, default)
+
+	def setdefault(self, key, default=None):
+		self.load((key,))
+		return super(HashSessionData, self).setdefault(key, default)
+
+	def pop(self, key, *default):
+		self.load((key,))
+		return super(HashSessionData, self).pop(key, *default)
+
+	def popitem(self):
+		self.load()
+		return super(HashSessionData, self).popitem()
+
+	def values(self):
+		self.load()
+		return dict.values(self)
+
+	def items(self):
+		self.load()
+		return dict.items(self)
+
+	def copy(self):
+		self.load()
+		return dict(dict.items(self))
+
+	def __eq__(self, other):
+		if not isinstance(other, dict):
+			return NotImplemented
+		self.load()
+		return dict.__eq__(self, other)
+
+	def __ne__(self, other):
+		rv = self.__eq__(other)
+		return rv if rv is NotImplemented else not rv
+
+	def __repr__(self):
+		self.load()
+		return super(HashSessionData, self).__repr__()
+
+
+
 class Session(object):
 	"""Session Object."""
 
@@ -36,6 +278,11 @@ class Session(object):
 		last_updated = lambda s: datetime.now()
 	)
 
+	#: Fields whose changes mark the session as modified. Changes to the
+	#: dicts, lists and sets nested in them are tracked too. In-place changes
+	#: to other mutable values must be flagged with `session.modified = True`.
+	__tracked__ = frozenset(('data', 'flashed', 'xflashed', 'immortals'))
+
 	new = False
 	modified = True
 	_started = None
@@ -48,6 +295,21 @@ class Session(object):
 			initial = kwargs
 		self._initial = initial
 
+	@classmethod
+	def lazy(cls, loader, app, request, **attrs):
+		"""Return a session that is only loaded and started when it's first
+		accessed. `loader()` must return the session's initial data or None.
+		The given `attrs` are set on the session once it's started.
+		"""
+		rv = cls()
+		rv.__dict__['_loader'] = (loader, app, request, attrs)
+		return rv
+
+	@property
+	def loaded(self):
+		"""False for lazy sessions that were never accessed."""
+		return '_loader' not in self.__dict__
+
 
 	#####################
 	# Extra goodies.
@@ -201,8 +463,11 @@ class Session(object):
 			self._init_attrs(**self._initial)
 			del self._initial
 		else:
+			self.new = True
 			self._init_attrs()
 
+		self.modified = self.new
+
 		if self.lifespan and (datetime.now() - self.last_updated) >= self.lifespan:
 			self._clear_expired_data()
 			self.invalidated = self.id
@@ -231,6 +496,13 @@ class Session(object):
 
 		return data
 
+	def _load(self):
+		loader, app, request, attrs = self.__dict__.pop('_loader')
+		self._initial = loader() or {}
+		self.start_session(app, request)
+		for key, value in attrs.items():
+			setattr(self, key, value)
+
 	def _clear_expired_data(self):
 		self.immortals = self.immortals & set(self.keys())
 		data = {key : self.data[key] for key in self.immortals}
@@ -287,7 +559,13 @@ class Session(object):
 		return rv
 
 	def _gather_storage_data(self):
-		return self._todict()
+		rv = self._todict()
+		for key in self.__tracked__:
+			rv[key] = dict(dict.items(rv[key])) if isinstance(rv[key], dict) else set(rv[key])
+		return rv
+
+	def _mark_modified(self, value=None):
+		self.modified = True
 
 	def _clear_refs(self, *keys):
 		for key in keys:
@@ -317,8 +595,25 @@ class Session(object):
 		self.data.__delitem__(key)
 		self._clear_refs(key)
 
+	def __setattr__(self, key, value):
+		if key in self.__tracked__:
+			if self.__dict__.get(key, NOTHING) != value:
+				self.__dict__['modified'] = True
+			if isinstance(value, (TrackedDict, CallbackSet)) and value.on_update is None:
+				value.on_update = self._mark_modified
+			elif isinstance(value, dict):
+				value = TrackedDict(value, self._mark_modified)
+			else:
+				value = CallbackSet(value, self._mark_modified)
+		object.__setattr__(self, key, value)
+
 	def __getattr__(self, key):
-		if not self._started and '_initial' in self.__dict__:
+		if key not in self.__fields__:
+			raise AttributeError('Session has no attribute {}.'.format(key))
+		elif '_loader' in self.__dict__:
+			self._load()
+			return getattr(self, key)
+		elif not self._started and '_initial' in self.__dict__:
 			raise RuntimeError(
 					'Error accessing session data. '\
 					'The session is not active. The session must '\
@@ -391,24 +686,29 @@ SecureCookieSessionInterface.__doc__ = BaseCookieInterface.__doc__
 
 
 
-class RedisSessionInterface(SessionInterface, BaseCookieInterface):
-	redis_serializer = pickle
-	redis = None
-	prefix = 'session:'
-	salt = 'redis-session'
+class ServerSessionInterface(SessionInterface, BaseCookieInterface):
+	"""Base for the interfaces that store sessions on the server. The cookie
+	only holds the signed session id. Sessions are opened lazily and loaded
+	with :meth:`load_session_data` on first access.
+	"""
 
-	def __init__(self, redis=None, prefix=None, **opts):
-		super(RedisSessionInterface, self).__init__(**opts)
-		self.redis = redis or self.redis
-		self.prefix = prefix or self.prefix
+	def open_session(self, app, request):
+		return self.session_class.lazy(
+					partial(self.load_session_data, app, request),
+					app, request,
+					lifespan=self.get_session_data_lifespan(app)
+				)
 
-	def get_prefix(self, app):
-		return self.prefix or app.config.get('SESSION_REDIS_PREFIX', '%s_user_session:' % app.name)
+	def load_session_data(self, app, request):
+		"""Return the stored session (a dict) for request or None."""
+		raise NotImplementedError
 
-	def get_redis_session_lifetime(self, app, session):
-		if session.permanent:
-			return app.permanent_session_lifetime
-		return timedelta(days=14)
+	def get_refresh_window(self, app):
+		"""Unmodified sessions saved within this window (the
+		SESSION_REFRESH_WINDOW config, in seconds or as a timedelta) of their
+		last write are not written at all.
+		"""
+		return _make_timedelta(app.config.get('SESSION_REFRESH_WINDOW') or 0)
 
 	def load_session_id(self, app, request):
 		s = self.get_signing_serializer(app)
@@ -428,36 +728,86 @@ class RedisSessionInterface(SessionInterface, BaseCookieInterface):
 		except BadSignature:
 			return None
 
+	def set_session_cookie(self, app, session, response, expires):
+		domain = self.get_cookie_domain(app)
+		path = self.get_cookie_path(app) or '/'
+		httponly = self.get_cookie_httponly(app)
+		secure = self.get_cookie_secure(app)
+		val = self.get_signing_serializer(app).dumps(session.id)
+
+		response.set_cookie(app.session_cookie_name, val,
+							expires=expires, httponly=httponly,
+							domain=domain, path=path, secure=secure)
+
+
+
+class RedisSessionInterface(ServerSessionInterface):
+	#: Encodes sessions stored in redis. Any object with `dumps()` and
+	#: `loads()`. The default :class:`~flex.core.session_codecs.SessionCodec`
+	#: still reads sessions pickled by older versions.
+	redis_serializer = SessionCodec()
+	redis = None
+	prefix = 'session:'
+	salt = 'redis-session'
+
+	def __init__(self, redis=None, prefix=None, redis_serializer=None, **opts):
+		super(RedisSessionInterface, self).__init__(**opts)
+		self.redis = redis or self.redis
+		self.prefix = prefix or self.prefix
+		self.redis_serializer = redis_serializer or self.redis_serializer
+
+	def get_redis(self, app):
+		"""Return the redis client. `redis` can be a client instance or a url,
+		in which case the client uses the process-wide connection pool of
+		:mod:`flex.redis`. Defaults to the app's :class:`flex.redis.RedisManager`
+		client if there's one.
+		"""
+		if isinstance(self.redis, str):
+			self.redis = get_redis_client(self.redis)
+		elif self.redis is None and 'redis' in app.extensions:
+			return app.extensions['redis'].client
+		return self.redis
+
+	def get_prefix(self, app):
+		return self.prefix or app.config.get('SESSION_REDIS_PREFIX', '%s_user_session:' % app.name)
+
+	def get_redis_session_lifetime(self, app, session):
+		if session.permanent:
+			return app.permanent_session_lifetime
+		return timedelta(days=14)
+
 	def open_session(self, app, request):
-		if not self.redis:
+		"""Return a lazy session. It's only fetched from redis and started
+		when it's first accessed, so requests that don't use the session
+		cost no round trip.
+		"""
+		if not self.get_redis(app):
 			warn("RedisSessionInterface requires a redix client instance.")
 			return None
+
+		return super(RedisSessionInterface, self).open_session(app, request)
+
+	def load_session_data(self, app, request):
 		sid = self.load_session_id(app, request)
 		if sid:
-			val = self.redis.get(self.get_prefix(app) + sid)
+			val = self.get_redis(app).get(self.get_prefix(app) + sid)
 			if val is not None:
-				data = self.redis_serializer.loads(val)
-			else:
-				data = None
-		else:
-			data = None
-
-		session = self.session_class(data)
-		session.start_session(app, request)
-		session.lifespan = self.get_session_data_lifespan(app)
-		return session
+				return self.redis_serializer.loads(val)
 
 	def save_session(self, app, session, response):
-		if not self.redis:
+		if not session.loaded:
+			return
+
+		redis = self.get_redis(app)
+		if not redis:
 			warn("RedisSessionInterface requires a redix client instance.")
 			return
 
 		domain = self.get_cookie_domain(app)
 		path = self.get_cookie_path(app) or '/'
 		if not session:
-			if hasattr(session, 'id'):
-
-				self.redis.delete(self.get_prefix(app) + session.id)
+			if hasattr(session, 'id') and not session.new:
+				redis.delete(self.get_prefix(app) + session.id)
 
 			if session.modified:
 				response.delete_cookie(
@@ -468,30 +818,318 @@ class RedisSessionInterface(SessionInterface, BaseCookieInterface):
 
 		prefix = self.get_prefix(app)
 		if session.invalidated:
-			self.redis.delete(prefix + session.invalidated)
+			redis.delete(prefix + session.invalidated)
 
+		last_updated = session.last_updated
 		data = session.end_session(app, response)
 
 		redis_exp = self.get_redis_session_lifetime(app, session)
 		cookie_exp = self.get_expiration_time(app, session)
 
+		if not (session.modified or session.invalidated):
+			# Unmodified sessions are not rewritten. Their ttl is only slid
+			# once they're out of the refresh window. last_updated (which the
+			# data lifespan is measured from) is only rewritten once half of
+			# the lifespan has passed.
+			age = datetime.now() - last_updated
+			if age < self.get_refresh_window(app):
+				return
+			elif not session.lifespan or age < session.lifespan / 2:
+				redis.expire(prefix + session.id, redis_exp)
+				if self.should_set_cookie(app, session):
+					self.set_session_cookie(app, session, response, cookie_exp)
+				return
+
 		val = self.redis_serializer.dumps(data)
-		cls = getattr(self.redis, 'provider_class', self.redis.__class__)
+		cls = getattr(redis, 'provider_class', redis.__class__)
 
 		if cls is Redis or issubclass(cls, Redis):
-			self.redis.setex(prefix + session.id, val, redis_exp)
+			redis.setex(prefix + session.id, val, redis_exp)
 		else:
-			self.redis.setex(prefix + session.id, redis_exp, val)
+			redis.setex(prefix + session.id, redis_exp, val)
 
-		httponly = self.get_cookie_httponly(app)
-		secure = self.get_cookie_secure(app)
-		val = self.get_signing_serializer(app).dumps(session.id)
+		self.set_session_cookie(app, session, response, cookie_exp)
 
-		response.set_cookie(app.session_cookie_name, val,
-							expires=cookie_exp, httponly=httponly,
-							domain=domain, path=path, secure=secure)
+	def scan_keys(self, app, count=1000):
+		"""Yield the stored session keys in batches of about `count`. The
+		keyspace is walked with SCAN so redis is never blocked for long.
+		"""
+		redis = self.get_redis(app)
+		match = self.get_prefix(app) + '*'
+		cursor = None
+		while cursor != 0:
+			cursor, keys = redis.scan(cursor or 0, match=match, count=count)
+			if keys:
+				yield keys
+
+	def get_sizes(self, app, keys):
+		"""Return the stored size in bytes of each of the session keys (0 if
+		the key is gone).
+		"""
+		pipe = self.get_redis(app).pipeline(transaction=False)
+		for key in keys:
+			pipe.strlen(key)
+		return pipe.execute()
+
+	def get_stored_sessions(self, app, keys):
+		"""Return the decoded session of each of the keys (None if the key is
+		gone or can't be decoded).
+		"""
+		pipe = self.get_redis(app).pipeline(transaction=False)
+		for key in keys:
+			pipe.get(key)
+		return [self._loads_or_none(v) for v in pipe.execute()]
+
+	def get_last_updated(self, app, keys):
+		"""Return when each of the session keys was last updated."""
+		return [s and s.get('last_updated') for s in self.get_stored_sessions(app, keys)]
+
+	def get_data_values(self, app, keys, name):
+		"""Return the value of session data key `name` of each of the keys."""
+		return [s and (s.get('data') or {}).get(name) for s in self.get_stored_sessions(app, keys)]
+
+	def delete_keys(self, app, keys):
+		"""Delete the session keys with UNLINK (so their memory is reclaimed in
+		the background) or DEL on servers without it. Returns the number
+		of keys deleted.
+		"""
+		if not keys:
+			return 0
+		redis = self.get_redis(app)
+		try:
+			return redis.execute_command('UNLINK', *keys)
+		except ResponseError:
+			return redis.delete(*keys)
+
+	def _loads_or_none(self, value):
+		if value is None:
+			return None
+		try:
+			return self.redis_serializer.loads(value)
+		except Exception:
+			return None
+
+
+
+
+
+# Clients created with decode_responses=True return str field names and
+# values. Names are compared as str and values as bytes.
+
+def _field_name(field):
+	return field.decode('utf-8') if isinstance(field, bytes) else field
 
 
+def _field_value(value):
+	return value.encode('utf-8') if isinstance(value, str) else value
+
+
+
+class RedisHashSessionInterface(RedisSessionInterface):
+	"""Stores each session as a redis hash instead of a single encoded value.
+	Each data key is stored in its own field (`d:<key>`) and so is each of
+	the other session fields (`m:<name>`). Saving a modified session only
+	writes the fields that changed, with HSET and HDEL.
+
+	Sessions are read with a single HGETALL. If `lazy_fields` is true, only
+	the metadata fields and the names of the data keys are read up front and
+	data values are fetched when they're first accessed.
+
+	Sessions stored by :class:`RedisSessionInterface` can still be read and
+	are converted on their next write.
+	"""
+
+	data_prefix = 'd:'
+	meta_prefix = 'm:'
+	lazy_fields = False
+
+	def __init__(self, redis=None, prefix=None, lazy_fields=None, **opts):
+		super(RedisHashSessionInterface, self).__init__(redis, prefix, **opts)
+		if lazy_fields is not None:
+			self.lazy_fields = lazy_fields
+
+	def get_meta_fields(self):
+		return [k for k in self.session_class.__fields__ if k not in ('id', 'data')]
+
+	def load_session_data(self, app, request):
+		sid = self.load_session_id(app, request)
+		if not sid:
+			return None
+
+		redis = self.get_redis(app)
+		key = self.get_prefix(app) + sid
+		try:
+			if self.lazy_fields:
+				meta = [self.meta_prefix + f for f in self.get_meta_fields()]
+				pipe = redis.pipeline(transaction=False)
+				pipe.hmget(key, meta)
+				pipe.hkeys(key)
+				values, fields = pipe.execute()
+				stored = {_field_name(f): None for f in fields}
+				stored.update((f, _field_value(v)) for f, v in zip(meta, values) if v is not None)
+			else:
+				stored = {_field_name(f): _field_value(v) for f, v in redis.hgetall(key).items()}
+		except ResponseError:
+			# Not a hash. It was stored by RedisSessionInterface.
+			rv = super(RedisHashSessionInterface, self).load_session_data(app, request)
+			if rv is not None:
+				rv['data'] = HashSessionData(rv.get('data'))
+			return rv
+
+		if not stored:
+			return None
+
+		loads = self.redis_serializer.loads
+		rv = {}
+		for name in self.get_meta_fields():
+			value = stored.get(self.meta_prefix + name)
+			if value is not None:
+				rv[name] = loads(value)
+
+		data, dp = {}, self.data_prefix
+		for field, value in stored.items():
+			if field.startswith(dp):
+				data[field[len(dp):]] = NOT_LOADED if value is None else loads(value)
+
+		rv['id'] = sid
+		rv['data'] = HashSessionData(data,
+					loader=partial(self._load_data_fields, redis, key, stored),
+					stored=stored)
+		return rv
+
+	def _load_data_fields(self, redis, key, stored, keys):
+		fields = [self.data_prefix + k for k in keys]
+		rv = {}
+		for k, field, value in zip(keys, fields, redis.hmget(key, fields)):
+			if value is not None:
+				stored[field] = value = _field_value(value)
+				rv[k] = self.redis_serializer.loads(value)
+		return rv
+
+	def save_session(self, app, session, response):
+		if not session.loaded:
+			return
+
+		redis = self.get_redis(app)
+		if not redis:
+			warn("RedisHashSessionInterface requires a redix client instance.")
+			return
+
+		prefix = self.get_prefix(app)
+		if not session:
+			if hasattr(session, 'id') and not session.new:
+				redis.delete(prefix + session.id)
+
+			if session.modified:
+				response.delete_cookie(
+					app.session_cookie_name,
+					domain=self.get_cookie_domain(app),
+					path=self.get_cookie_path(app) or '/'
+				)
+			return
+
+		last_updated = session.last_updated
+		session.end_session(app, response)
+
+		key = prefix + session.id
+		redis_exp = self.get_redis_session_lifetime(app, session)
+		cookie_exp = self.get_expiration_time(app, session)
+		dumps = self.redis_serializer.dumps
+		pipe = redis.pipeline()
+
+		if session.invalidated:
+			pipe.delete(prefix + session.invalidated)
+
+		data = session.data
+		stored = getattr(data, 'stored', None)
+		if not (session.modified or session.invalidated or stored is None):
+			# Unmodified sessions are not written within the refresh window.
+			# Past it, only last_updated and the ttl are refreshed.
+			if datetime.now() - last_updated < self.get_refresh_window(app):
+				return
+			pipe.hset(key, self.meta_prefix + 'last_updated', dumps(session.last_updated))
+			pipe.expire(key, redis_exp)
+			pipe.execute()
+			if self.should_set_cookie(app, session):
+				self.set_session_cookie(app, session, response, cookie_exp)
+			return
+
+		if stored is None or session.invalidated:
+			# A new, renewed or converted session. Write all of its fields.
+			if isinstance(data, HashSessionData):
+				data.load()
+			if not session.new:
+				pipe.delete(key)
+			stored = {}
+
+		changed = {}
+		for name in self.get_meta_fields():
+			value = getattr(session, name)
+			if isinstance(value, (set, dict)):
+				value = dict(dict.items(value)) if isinstance(value, dict) else set(value)
+			value = dumps(value)
+			if stored.get(self.meta_prefix + name) != value:
+				changed[self.meta_prefix + name] = value
+
+		dp = self.data_prefix
+		for k, value in dict.items(data):
+			if value is not NOT_LOADED:
+				value = dumps(value)
+				if stored.get(dp + k) != value:
+					changed[dp + k] = value
+
+		removed = [f for f in stored if f.startswith(dp) and f[len(dp):] not in data]
+		if changed:
+			pipe.hmset(key, changed)
+		if removed:
+			pipe.hdel(key, *removed)
+		pipe.expire(key, redis_exp)
+		pipe.execute()
+
+		if isinstance(data, HashSessionData):
+			data.stored = stored
+			stored.update(changed)
+			for field in removed:
+				del stored[field]
+
+		self.set_session_cookie(app, session, response, cookie_exp)
+
+	def get_sizes(self, app, keys):
+		# Sessions stored by RedisSessionInterface are still plain strings.
+		return self._hash_or_string(app, keys, 'hvals',
+				super(RedisHashSessionInterface, self).get_sizes,
+				lambda vals: sum(len(v) for v in vals) if vals else 0)
+
+	def get_last_updated(self, app, keys):
+		field = self.meta_prefix + 'last_updated'
+		return self._hash_or_string(app, keys, 'hget',
+				super(RedisHashSessionInterface, self).get_last_updated,
+				self._loads_or_none, field)
+
+	def get_data_values(self, app, keys, name):
+		field = self.data_prefix + name
+		parent = super(RedisHashSessionInterface, self).get_data_values
+		return self._hash_or_string(app, keys, 'hget',
+				lambda app, keys: parent(app, keys, name),
+				self._loads_or_none, field)
+
+	def _hash_or_string(self, app, keys, command, fallback, convert, *args):
+		"""Run the hash `command` on each of the keys. Keys holding legacy
+		string sessions are handled by `fallback`.
+		"""
+		pipe = self.get_redis(app).pipeline(transaction=False)
+		for key in keys:
+			getattr(pipe, command)(key, *args)
+		rv = pipe.execute(raise_on_error=False)
+
+		legacy = [i for i, v in enumerate(rv) if isinstance(v, ResponseError)]
+		for i, v in enumerate(rv):
+			if not isinstance(v, ResponseError):
+				rv[i] = convert(v)
+		if legacy:
+			for i, v in zip(legacy, fallback(app, [keys[i] for i in legacy])):
+				rv[i] = v
+		return rv
 
 
 def generate_session_id(app=None):
@@ -0,0 +1,47 @@
+from decimal import Decimal
+from datetime import date, datetime, timedelta
+
+import pytest
+
+from flex.core.sessions import RedisSessionInterface
+from flex.core.session_codecs import SessionCodec, FORMATS, msgpack_available
+
+
+class Point(object):
+
+	def __init__(self, x, y):
+		self.x, self.y = x, y
+
+	def __eq__(self, other):
+		return isinstance(other, Point) and (self.x, self.y) == (other.x, other.y)
+
+
+SESSION = {
+	'price': Decimal('10.50'),
+	'day': date(2020, 2, 29),
+	'at': datetime(2020, 2, 29, 12, 30, 15, 500),
+	'ttl': timedelta(minutes=5),
+	'point': Point(1, 2),
+	'tags': {'a', 'b'},
+	'frozen': frozenset({1, 2}),
+	'pair': (1, 'x'),
+	'by_id': {1: 'one', (2, 3): 'pair'},
+	'raw': b'\x00\xff',
+	'nested': {' not a tag': [1, {'x': None}]},
+}
+
+
+def test_default_interface_roundtrips_any_picklable_value():
+	codec = RedisSessionInterface.redis_serializer
+	assert codec.loads(codec.dumps(SESSION)) == SESSION
+
+
+@pytest.mark.parametrize('format', [
+	f for f in FORMATS if f != 'msgpack' or msgpack_available
+])
+def test_formats_roundtrip_any_picklable_value(format):
+	codec = SessionCodec(format)
+	rv = codec.loads(codec.dumps(SESSION))
+	assert rv == SESSION
+	assert type(rv['frozen']) is frozenset
+	assert type(rv['pair']) is tuple
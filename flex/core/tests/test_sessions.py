@@ -0,0 +1,44 @@
+import pickle
+
+from flex.core.sessions import Session
+
+
+def start_session(data):
+	rv = Session({'data': data})
+	rv.start_session(None, None)
+	assert not rv.modified
+	return rv
+
+
+def test_nested_list_mutation_marks_session_modified():
+	session = start_session({'cart': [{'items': []}]})
+	session['cart'][0]['items'].append('apple')
+	assert session.modified
+	assert session['cart'] == [{'items': ['apple']}]
+
+
+def test_nested_dict_mutation_marks_session_modified():
+	session = start_session({'a': {'b': {'c': 0}}})
+	session['a']['b']['c'] = 1
+	assert session.modified
+
+
+def test_values_assigned_later_are_tracked():
+	session = start_session({})
+	session.setdefault('cart', []).append(1)
+	session.modified = False
+	session['cart'].append(2)
+	assert session.modified
+
+
+def test_reading_does_not_mark_session_modified():
+	session = start_session({'cart': [1], 'a': {'b': {1, 2}}})
+	assert session['cart'][0] == 1 and 1 in session['a']['b']
+	assert not session.modified
+
+
+def test_tracked_values_pickle_as_plain_types():
+	session = start_session({'cart': [{'tags': {'x'}}]})
+	rv = pickle.loads(pickle.dumps(session.data))
+	assert type(rv) is dict and type(rv['cart']) is list
+	assert type(rv['cart'][0]) is dict and type(rv['cart'][0]['tags']) is set
@@ -0,0 +1,297 @@
+"Server-side sessions stored in an SQL table."
+
+import os
+import time
+import atexit
+import logging
+from threading import Lock, Thread, Event
+from datetime import datetime, timedelta
+
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+from flex.core.sessions import ServerSessionInterface
+from flex.core.session_codecs import SessionCodec
+from .utils import app_get_db_client
+
+
+__all__ = ('SQLSessionInterface', 'WriteBehindBuffer', 'make_session_table')
+
+
+logger = logging.getLogger(__name__)
+
+#: Buffered in place of a session that must be deleted.
+DELETE = object()
+
+
+def make_session_table(name='sessions', metadata=None):
+	"""Return the sessions table. Pass your models' metadata to have the
+	table picked up by migrations.
+	"""
+	return sa.Table(
+		name, sa.MetaData() if metadata is None else metadata,
+		sa.Column('id', sa.String(64), primary_key=True),
+		sa.Column('data', sa.LargeBinary, nullable=False),
+		sa.Column('expires_at', sa.DateTime, nullable=False, index=True),
+	)
+
+
+
+class WriteBehindBuffer(object):
+	"""Collects writes keyed by session id and hands them to `write(pending)`
+	in batches from a background thread. Only the latest write of each
+	session is kept, so a session saved several times between flushes is
+	written once.
+
+	The buffer is flushed every `interval` seconds, as soon as it holds
+	`batch_size` writes and at exit. `periodic()` (if given) is called from
+	the same thread every `periodic_interval` seconds.
+	"""
+
+	def __init__(self, write, interval=1.0, batch_size=500, periodic=None, periodic_interval=300):
+		self.write = write
+		self.interval = interval
+		self.batch_size = batch_size
+		self.periodic = periodic
+		self.periodic_interval = periodic_interval
+		self._pending = {}
+		self._lock = Lock()
+		self._wakeup = Event()
+		self._thread = None
+		self._pid = None
+		self._last_periodic = time.monotonic()
+
+	def get(self, key):
+		return self._pending.get(key)
+
+	def put(self, key, value):
+		"""Buffer a write. `value` is a (data, expires_at) tuple, with data
+		None to only update expires_at, or :data:`DELETE`.
+		"""
+		with self._lock:
+			current = self._pending.get(key)
+			if value is not DELETE and value[0] is None \
+					and current is not None and current is not DELETE:
+				# Only extends a write that's still pending.
+				value = (current[0], value[1])
+			self._pending[key] = value
+			full = len(self._pending) >= self.batch_size
+		self._ensure_thread()
+		if full:
+			self._wakeup.set()
+
+	def flush(self):
+		"""Write the pending writes now. Returns False if they failed, in
+		which case they are kept for the next flush.
+		"""
+		with self._lock:
+			pending, self._pending = self._pending, {}
+		if not pending:
+			return True
+		try:
+			self.write(pending)
+		except Exception as e:
+			logger.exception('Failed to write %d buffered sessions: %s' % (len(pending), e))
+			with self._lock:
+				for key, value in pending.items():
+					self._pending.setdefault(key, value)
+			return False
+		return True
+
+	def close(self):
+		self._thread, thread = None, self._thread
+		self._wakeup.set()
+		if thread is not None and thread.is_alive():
+			thread.join(self.interval + 5)
+		self.flush()
+
+	def _ensure_thread(self):
+		# Threads don't survive forks, so each worker process starts its own.
+		if self._pid != os.getpid():
+			with self._lock:
+				if self._pid != os.getpid():
+					self._thread = Thread(target=self._run, name='session-write-behind', daemon=True)
+					self._thread.start()
+					if self._pid is None:
+						atexit.register(self.close)
+					self._pid = os.getpid()
+
+	def _run(self):
+		current = self._thread
+		while self._thread is current:
+			self._wakeup.wait(self.interval)
+			self._wakeup.clear()
+			self.flush()
+			if self.periodic and time.monotonic() - self._last_periodic >= self.periodic_interval:
+				self._last_periodic = time.monotonic()
+				try:
+					self.periodic()
+				except Exception as e:
+					logger.exception('Session buffer periodic task failed: %s' % e)
+
+
+
+class SQLSessionInterface(ServerSessionInterface):
+	"""Stores sessions in an SQL table of the app's :mod:`flex.db` client.
+
+	Each session is read by primary key with a single query. Writes go to a
+	:class:`WriteBehindBuffer` and are flushed in batched upserts (native on
+	PostgreSQL, delete + insert elsewhere) by a background thread, so saving
+	a session costs no query in the request. Sessions are visible to other
+	processes once flushed, i.e. after about `flush_interval` seconds.
+	Expired rows are deleted every `cleanup_interval` seconds through the
+	index on `expires_at`.
+
+	Options:
+		table_name: name of the table (default 'sessions').
+		bind: the :mod:`flex.db` bind to use.
+		metadata: the metadata the table is defined on (see
+			:func:`make_session_table`).
+	"""
+	#: Encodes the stored sessions. Any object with `dumps()` and `loads()`.
+	sql_serializer = SessionCodec()
+	salt = 'sql-session'
+	table_name = 'sessions'
+
+	def __init__(self, table_name=None, bind=None, metadata=None, sql_serializer=None,
+				flush_interval=1.0, batch_size=500, cleanup_interval=300, **opts):
+		super(SQLSessionInterface, self).__init__(**opts)
+		self.bind = bind
+		self.sql_serializer = sql_serializer or self.sql_serializer
+		self.table = make_session_table(table_name or self.table_name, metadata)
+		self.flush_interval = flush_interval
+		self.batch_size = batch_size
+		self.cleanup_interval = cleanup_interval
+		self._buffers = {}
+		self._buffers_lock = Lock()
+
+	def get_engine(self, app):
+		return app_get_db_client(app).get_engine(app, bind=self.bind)
+
+	def get_buffer(self, app):
+		rv = self._buffers.get(app)
+		if rv is None:
+			with self._buffers_lock:
+				rv = self._buffers.get(app)
+				if rv is None:
+					rv = self._buffers[app] = WriteBehindBuffer(
+							lambda pending: self.write_sessions(app, pending),
+							interval=self.flush_interval,
+							batch_size=self.batch_size,
+							periodic=lambda: self.purge_expired(app),
+							periodic_interval=self.cleanup_interval,
+						)
+		return rv
+
+	def create_table(self, app):
+		self.table.create(self.get_engine(app), checkfirst=True)
+
+	def get_storage_lifetime(self, app, session):
+		if session.permanent:
+			return app.permanent_session_lifetime
+		return timedelta(days=14)
+
+	def load_session_data(self, app, request):
+		sid = self.load_session_id(app, request)
+		if not sid:
+			return None
+
+		# Writes still in the buffer are newer than the stored row.
+		buffered = self.get_buffer(app).get(sid)
+		if buffered is DELETE:
+			return None
+		elif buffered is not None and buffered[0] is not None:
+			return self.sql_serializer.loads(buffered[0])
+
+		t = self.table
+		row = self.get_engine(app).execute(
+					sa.select([t.c.data, t.c.expires_at]).where(t.c.id == sid)
+				).first()
+		if row is not None and row.expires_at > datetime.utcnow():
+			return self.sql_serializer.loads(row.data)
+
+	def save_session(self, app, session, response):
+		if not session.loaded:
+			return
+
+		buffer = self.get_buffer(app)
+		if not session:
+			if hasattr(session, 'id') and not session.new:
+				buffer.put(session.id, DELETE)
+
+			if session.modified:
+				response.delete_cookie(
+					app.session_cookie_name,
+					domain=self.get_cookie_domain(app),
+					path=self.get_cookie_path(app) or '/'
+				)
+			return
+
+		if session.invalidated:
+			buffer.put(session.invalidated, DELETE)
+
+		last_updated = session.last_updated
+		data = session.end_session(app, response)
+
+		expires_at = datetime.utcnow() + self.get_storage_lifetime(app, session)
+		cookie_exp = self.get_expiration_time(app, session)
+
+		if not (session.modified or session.invalidated):
+			# Like RedisSessionInterface, unmodified sessions are only
+			# touched outside the refresh window and only rewritten once
+			# half of the data lifespan has passed.
+			age = datetime.now() - last_updated
+			if age < self.get_refresh_window(app):
+				return
+			elif not session.lifespan or age < session.lifespan / 2:
+				buffer.put(session.id, (None, expires_at))
+				if self.should_set_cookie(app, session):
+					self.set_session_cookie(app, session, response, cookie_exp)
+				return
+
+		buffer.put(session.id, (self.sql_serializer.dumps(data), expires_at))
+		self.set_session_cookie(app, session, response, cookie_exp)
+
+	def write_sessions(self, app, pending):
+		"""Write the buffered sessions (a dict of session id to a buffer
+		value) in batches of `batch_size` rows, in a single transaction.
+		"""
+		t = self.table
+		deleted, upserts, touched = [], [], []
+		for sid, value in pending.items():
+			if value is DELETE:
+				deleted.append(sid)
+			elif value[0] is None:
+				touched.append(dict(_id=sid, _expires_at=value[1]))
+			else:
+				upserts.append(dict(id=sid, data=value[0], expires_at=value[1]))
+
+		size = self.batch_size
+		with self.get_engine(app).begin() as conn:
+			for i in range(0, len(deleted), size):
+				conn.execute(t.delete().where(t.c.id.in_(deleted[i:i+size])))
+			for i in range(0, len(upserts), size):
+				self._upsert(conn, upserts[i:i+size])
+			if touched:
+				conn.execute(t.update()
+						.where(t.c.id == sa.bindparam('_id'))
+						.values(expires_at=sa.bindparam('_expires_at')), touched)
+
+	def _upsert(self, conn, rows):
+		t = self.table
+		if conn.dialect.name == 'postgresql':
+			stmt = postgresql.insert(t)
+			conn.execute(stmt.on_conflict_do_update(
+					index_elements=[t.c.id],
+					set_=dict(data=stmt.excluded.data, expires_at=stmt.excluded.expires_at)
+				), rows)
+		else:
+			conn.execute(t.delete().where(t.c.id.in_([r['id'] for r in rows])))
+			conn.execute(t.insert(), rows)
+
+	def purge_expired(self, app):
+		"""Delete the expired sessions. Returns the number of rows deleted."""
+		t = self.table
+		return self.get_engine(app).execute(
+					t.delete().where(t.c.expires_at <= datetime.utcnow())
+				).rowcount
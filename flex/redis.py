@@ -1,9 +1,178 @@
-from flask import current_app
+import time
+import logging
+from flask import current_app, g, has_app_context
 from threading import Lock
+from urllib.parse import urlsplit, parse_qsl
+from flex.signal import signals
 from flex.utils.module_loading import import_string
 
+try:
+	from redis import Redis
+	from redis.connection import ConnectionPool, BlockingConnectionPool
+	redis_available = True
+except ImportError:
+	redis_available = False
 
-__all__ = ('RedisManager', 'redis')
+
+__all__ = (
+	'RedisManager', 'redis', 'get_client', 'get_connection_pool', 'pool_stats',
+	'batch_failed',
+)
+
+
+logger = logging.getLogger(__name__)
+
+#: Sent when deferred commands fail to run. The sender is the
+#: :class:`RedisManager` and the exceptions are passed as `errors`.
+batch_failed = signals.signal('redis.batch_failed')
+
+_BATCH_ATTR = '_flex_redis_batch'
+
+
+_pools = {}
+_clients = {}
+_registry_lock = Lock()
+
+
+class _PoolMetricsMixin(object):
+	"""Records how busy a connection pool is and how long callers wait for
+	a connection.
+	"""
+
+	def reset(self):
+		super(_PoolMetricsMixin, self).reset()
+		self._metrics_lock = Lock()
+		self.checkouts = self.errors = self.peak_in_use = 0
+		self.wait_time = self.max_wait_time = 0.0
+
+	def get_connection(self, command_name, *keys, **options):
+		started = time.perf_counter()
+		try:
+			rv = super(_PoolMetricsMixin, self).get_connection(command_name, *keys, **options)
+		except Exception:
+			with self._metrics_lock:
+				self.errors += 1
+			raise
+		waited = time.perf_counter() - started
+		in_use = self.in_use_count()
+		with self._metrics_lock:
+			self.checkouts += 1
+			self.wait_time += waited
+			if waited > self.max_wait_time:
+				self.max_wait_time = waited
+			if in_use > self.peak_in_use:
+				self.peak_in_use = in_use
+		return rv
+
+	def stats(self):
+		in_use = self.in_use_count()
+		return dict(
+			max_connections=self.max_connections,
+			in_use=in_use,
+			peak_in_use=self.peak_in_use,
+			saturation=in_use / self.max_connections,
+			checkouts=self.checkouts,
+			errors=self.errors,
+			wait_time=self.wait_time,
+			max_wait_time=self.max_wait_time,
+			mean_wait_time=self.checkouts and self.wait_time / self.checkouts,
+		)
+
+
+if redis_available:
+
+	class MeteredConnectionPool(_PoolMetricsMixin, ConnectionPool):
+		"""A :class:`redis.ConnectionPool` that records usage metrics."""
+
+		def in_use_count(self):
+			return len(self._in_use_connections)
+
+
+	class MeteredBlockingConnectionPool(_PoolMetricsMixin, BlockingConnectionPool):
+		"""A :class:`redis.BlockingConnectionPool` that records usage metrics.
+		Callers wait up to `timeout` seconds for a free connection instead of
+		failing once `max_connections` are in use.
+		"""
+
+		def in_use_count(self):
+			return self.pool.maxsize - self.pool.qsize()
+
+
+def _pool_key(url, options):
+	"""Normalize url and options so that equivalent configurations share the
+	same key.
+	"""
+	parts = urlsplit(url)
+	query = dict(parse_qsl(parts.query))
+	db = query.pop('db', None) or parts.path.strip('/') or '0'
+	port = parts.port or (6379 if parts.scheme in ('redis', 'rediss') else None)
+	host = parts.path if parts.scheme == 'unix' else (parts.hostname or 'localhost').lower()
+	location = (parts.scheme, parts.username, parts.password, host, port, str(db))
+	return location, tuple(sorted((k, repr(v)) for k, v in dict(query, **options).items()))
+
+
+def get_connection_pool(url, **options):
+	"""Return the process-wide connection pool for the given url and options,
+	creating it if needed. Besides the connection options accepted by
+	redis-py, options may include:
+
+		max_connections: the max number of connections in the pool.
+		health_check_interval: seconds after which an idle connection is
+			checked with a PING before use.
+		pool_blocking_timeout: if set, callers wait up to this many seconds
+			for a free connection instead of failing when the pool is full.
+	"""
+	key = _pool_key(url, options)
+	rv = _pools.get(key)
+	if rv is None:
+		with _registry_lock:
+			rv = _pools.get(key)
+			if rv is None:
+				options = dict(options)
+				timeout = options.pop('pool_blocking_timeout', None)
+				if timeout is None:
+					rv = MeteredConnectionPool.from_url(url, **options)
+				else:
+					options.setdefault('max_connections', 50)
+					rv = MeteredBlockingConnectionPool.from_url(url, timeout=timeout, **options)
+				_pools[key] = rv
+	return rv
+
+
+def get_client(url, client_class='redis.StrictRedis', **options):
+	"""Return a client of client_class for url backed by the shared pool
+	returned by :func:`get_connection_pool`. Clients with their own
+	`from_url()` (such as fakeredis) manage their connections themselves
+	and are only shared.
+	"""
+	if isinstance(client_class, str):
+		client_class = import_string(client_class)
+
+	key = (client_class, _pool_key(url, options))
+	rv = _clients.get(key)
+	if rv is None:
+		from_url = getattr(client_class.from_url, '__func__', None)
+		if redis_available and from_url is Redis.from_url.__func__:
+			client = client_class(connection_pool=get_connection_pool(url, **options))
+		else:
+			client = client_class.from_url(url, **options)
+		with _registry_lock:
+			rv = _clients.setdefault(key, client)
+	return rv
+
+
+def pool_stats():
+	"""Return the metrics of all the shared connection pools by url."""
+	with _registry_lock:
+		pools = list(_pools.items())
+
+	rv = {}
+	for ((scheme, user, password, host, port, db), options), pool in pools:
+		name = '%s://%s%s/%s' % (scheme, host, port and ':%s' % port or '', db)
+		if options:
+			name += '?' + '&'.join('%s=%s' % o for o in options)
+		rv[name] = pool.stats()
+	return rv
 
 
 class _Connector(object):
@@ -20,11 +189,9 @@ class _Connector(object):
 	def client(self):
 		with self.lock:
 			if self._client is None:
-				cls = self.config.CLIENT_CLASS
-				if isinstance(cls, str):
-					cls = import_string(cls)
-				self._client = cls.from_url(
+				self._client = get_client(
 						self.config.URL,
+						self.config.CLIENT_CLASS,
 						**self.config.CLIENT_OPTIONS
 					)
 			return self._client
@@ -51,9 +218,67 @@ class RedisManager(object):
 	@property
 	def _redis_client(self):
 		try:
-			return self._get_app().extensions['redis'].client
+			rv = self._get_app().extensions['redis'].client
 		except KeyError:
 			raise RuntimeError('Redis not setup on app.')
+		# Commands sent through the manager must see the deferred writes.
+		self.flush()
+		return rv
+
+	@property
+	def deferred(self):
+		"""A pipeline for fire-and-forget writes scoped to the current app
+		context (i.e. the current request). Queued commands are sent in a
+		single round trip when the context is torn down, when :meth:`flush`
+		is called or before any other command is sent through the manager.
+		Outside of an app context, commands are sent right away.
+
+		Example::
+
+			redis.deferred.incr('hits')
+			redis.deferred.expire('hits', 60)
+		"""
+		if not has_app_context():
+			return self._redis_client
+
+		rv = g.get(_BATCH_ATTR)
+		if rv is None:
+			try:
+				client = self._get_app().extensions['redis'].client
+			except KeyError:
+				raise RuntimeError('Redis not setup on app.')
+			rv = client.pipeline(transaction=False)
+			setattr(g, _BATCH_ATTR, rv)
+		return rv
+
+	def flush(self, raise_on_error=False):
+		"""Send the deferred commands of the current app context and return
+		their results. Failed commands are reported through the
+		:data:`batch_failed` signal and only raised if `raise_on_error` is
+		true.
+		"""
+		pipe = g.get(_BATCH_ATTR) if has_app_context() else None
+		if pipe is None or not len(pipe):
+			return []
+
+		try:
+			rv = pipe.execute(raise_on_error=False)
+		except Exception as e:
+			rv, errors = [], [e]
+		else:
+			errors = [r for r in rv if isinstance(r, Exception)]
+
+		if errors:
+			batch_failed.send(self, errors=errors)
+			if raise_on_error:
+				raise errors[0]
+		return rv
+
+	def _flush_on_teardown(self, exc=None):
+		try:
+			self.flush()
+		except Exception as e:
+			logger.exception('Failed to flush deferred redis commands: %s' % e)
 
 	def _get_app(self, app=None):
 		"""Helper method that implements the logic to look up an application."""
@@ -76,6 +301,7 @@ class RedisManager(object):
 		config.setdefaults(self.default_config)
 
 		app.extensions['redis'] = _Connector(app, config)
+		app.teardown_appcontext(self._flush_on_teardown)
 
 	def __getattr__(self, name):
 		return getattr(self._redis_client, name)
@@ -4,13 +4,13 @@ from collections import defaultdict, Iterable
 
 from flex.utils.decorators import export, deprecated
 
-from .signals import ANY, Signal, NamedSignal
+from .signals import ANY, Signal, NamedSignal, dispatcher, profiler, receiver_failed
 from .namespaces import Namespace, WeakNamespace
 
 
 
 __all__ = [
-	'ANY', 'signals'
+	'ANY', 'signals', 'dispatcher', 'profiler', 'receiver_failed'
 ]
 
 
@@ -92,6 +92,4 @@ def receiver(signal, sender=ANY, weak=True, retval=False):
 
 signals = Namespace()
 
-
-
-
+signals[receiver_failed.name] = receiver_failed
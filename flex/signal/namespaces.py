@@ -35,10 +35,10 @@ class BaseSignalNamespace(object):
 		"""
 		return self.signal(name, doc, **config)
 
-	def receiver(self, signal, sender=ANY, weak=True, retval=False):
+	def receiver(self, signal, sender=ANY, weak=True, retval=False, mode=None):
 		"""A decorator for connecting receivers to signals. Used by passing in the
 		signal (or list of signals) name(s) or instance(s) and a sender
-		(or list of senders).
+		(or list of senders). See :meth:`Signal.connect` for the `mode`.
 		"""
 		if not isinstance(signal, (list, tuple)):
 			signal = (signal,)
@@ -51,7 +51,7 @@ class BaseSignalNamespace(object):
 				if isinstance(sig, str):
 					sig = self.signal(sig)
 				for sen in sender:
-					sig.connect(fn, sen, weak, retval=retval)
+					sig.connect(fn, sen, weak, retval=retval, mode=mode)
 			return fn
 		return decorator
 
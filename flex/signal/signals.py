@@ -1,17 +1,33 @@
+import os
+import time
+import types
+import asyncio
+import inspect
+import logging
+from threading import Lock, Thread
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 import blinker as bl
-from blinker.base import ANY, ANY_ID, hashable_identity
+from flask import g, current_app, has_app_context, appcontext_tearing_down
+from flask.globals import _app_ctx_stack
+from blinker.base import ANY, ANY_ID, WeakTypes, hashable_identity
 
 from flex.utils.decorators import export, locked_cached_property
 
 
 __all__ = [
-	'ANY',
+	'ANY', 'MODES', 'dispatcher', 'profiler', 'receiver_failed',
 ]
 
 NOTHING = object()
 
+#: The delivery modes receivers can be connected with. Receivers connected
+#: with None (or 'sync') are called inline.
+MODES = (None, 'sync', 'thread', 'async', 'deferred')
+
+logger = logging.getLogger(__name__)
+
 
 @export
 class Signal(bl.Signal):
@@ -22,6 +38,8 @@ class Signal(bl.Signal):
 	def __init__(self, doc=None):
 		super(Signal, self).__init__(doc)
 		self._pipes = defaultdict(set)
+		self._modes = {}
+		self._dispatch = {}
 
 	@locked_cached_property
 	def receiver_connected(self):
@@ -72,7 +90,7 @@ class Signal(bl.Signal):
 				setattr(self, self._config_keys[k], kw[k])
 		return self
 
-	def connect(self, receiver, sender=ANY, weak=True, retval=False):
+	def connect(self, receiver, sender=ANY, weak=True, retval=False, mode=None):
 		"""Connect *receiver* to signal events sent by *sender*.
 
 		:param receiver: A callable.  Will be invoked by :meth:`send` with
@@ -89,11 +107,32 @@ class Signal(bl.Signal):
 		:param weak: If true, the Signal will hold a weakref to *receiver*
 		  and automatically disconnect when *receiver* goes out of scope or
 		  is garbage collected.  Defaults to True.
+
+		:param mode: How *receiver* is called (one of :data:`MODES`).
+		  ``'thread'`` runs it on the bounded thread pool of the
+		  :data:`dispatcher`, ``'async'`` on an asyncio loop (the running
+		  loop or the dispatcher's) and ``'deferred'`` once the current app
+		  context is torn down, i.e. after the response. The emitter gets a
+		  future (or None for deferred receivers) instead of the return
+		  value. The mode applies to all the senders *receiver* is connected
+		  to. Pipes (*retval*) are always called inline.
 		"""
+		if mode == 'sync':
+			mode = None
+		if mode not in MODES:
+			raise ValueError('Invalid receiver mode %r. Expected one of %s.' % (mode, MODES))
+		elif mode and retval:
+			raise ValueError('Pipes (retval=True) must be called inline.')
+
 		rv = super(Signal, self).connect(receiver, sender, weak)
 		if retval and rv:
 			sid = ANY_ID if sender is ANY else self.hashable_id(self.get_sender_id(sender))
 			self._pipes[self.hashable_id(receiver)].add(sid)
+		if mode:
+			self._modes[self.hashable_id(receiver)] = mode
+		else:
+			self._modes.pop(self.hashable_id(receiver), None)
+		self._dispatch = {}
 		return rv
 
 	def send(self, sender=None, *, value=NOTHING, **kwargs):
@@ -108,12 +147,15 @@ class Signal(bl.Signal):
 		:param \*\*kwargs: Data to be sent to receivers.
 
 		"""
+		if not self.receivers:
+			return []
 		return [r for r in self.trigger(sender, value=value, **kwargs)]
 
 	def trigger(self, sender=None, *, value=NOTHING, **kwargs):
 		"""Emit this signal on behalf of *sender*, passing on \*\*kwargs.
 
-		Returns a list of 2-tuples, pairing receivers with their return value.
+		Returns a list of 2-tuples, pairing receivers with their return value
+		(a future or None for receivers connected with a background `mode`).
 
 		:param \*sender: Any object or ``None``.  If omitted, synonymous
 		  with ``None``.  Only accepts one positional argument.
@@ -121,10 +163,21 @@ class Signal(bl.Signal):
 		:param \*\*kwargs: Data to be sent to receivers.
 
 		"""
+		if not self.receivers:
+			return
 		kw = dict(value=value, **kwargs) if value is not NOTHING else kwargs
 		sender_id = sender if sender is None else self.get_sender_id(sender)
-		for receiver in (self.receivers and self.receivers_for(sender_id) or ()):
-			yield receiver, receiver(sender, **kw)
+		timed = profiler.enabled
+		for receiver, weak, is_pipe, mode in self.get_dispatch_table(sender_id):
+			if weak:
+				receiver = receiver()
+				if receiver is None:
+					continue
+			if mode is None:
+				yield receiver, (profiler.call(self, receiver, sender, kw)
+						if timed else receiver(sender, **kw))
+			else:
+				yield receiver, dispatcher.dispatch(self, mode, receiver, sender, kw)
 
 	def pipe(self, sender=None, value=None, **kwargs):
 		"""Emit this signal on behalf of *sender* as a pipeline, passing on the
@@ -141,14 +194,67 @@ class Signal(bl.Signal):
 
 		:param \*\*kwargs: Data to be sent to receivers.
 		"""
+		if not self.receivers:
+			return value
 		sender_id = sender if sender is None else self.get_sender_id(sender)
-		for receiver in (self.receivers and self.receivers_for(sender_id) or ()):
-			if self.is_pipe(receiver, sender_id=sender_id):
-				value = receiver(sender, value=value, **kwargs)
+		timed = profiler.enabled
+		for receiver, weak, is_pipe, mode in self.get_dispatch_table(sender_id):
+			if weak:
+				receiver = receiver()
+				if receiver is None:
+					continue
+			if mode is None:
+				rv = profiler.call(self, receiver, sender, dict(kwargs, value=value)) \
+					if timed else receiver(sender, value=value, **kwargs)
+				if is_pipe:
+					value = rv
 			else:
-				receiver(sender, value=value, **kwargs)
+				dispatcher.dispatch(self, mode, receiver, sender, dict(kwargs, value=value))
 		return value
 
+	def get_dispatch_table(self, sender_id):
+		"""Return the receivers for *sender_id* as a tuple of
+		`(receiver, weak, is_pipe, mode)` entries. Weak receivers are returned as
+		their weak reference.
+
+		Tables are built once per sender with receivers of its own (all other
+		senders share the table of :obj:`ANY` receivers) and dropped whenever
+		a receiver is connected or disconnected or a weakly referenced
+		receiver or sender dies.
+		"""
+		key = self.hashable_id(sender_id)
+		if key not in self._by_sender:
+			key = ANY_ID
+		# A None sender gets a table of its own since any receiver connected
+		# as a pipe pipes its value (see :meth:`is_pipe`).
+		cache_key = (key,) if sender_id is None else key
+		dispatch = self._dispatch
+		rv = dispatch.get(cache_key)
+		if rv is None:
+			# Stored in the table current when the build started so that a
+			# build racing an invalidation can't be cached.
+			rv = dispatch[cache_key] = self._build_dispatch_table(key, sender_id is None)
+		return rv
+
+	def _build_dispatch_table(self, key, any_pipe=False):
+		ids = set(self._by_sender.get(ANY_ID, ()))
+		if key != ANY_ID:
+			ids.update(self._by_sender.get(key, ()))
+
+		rv = []
+		for receiver_id in ids:
+			receiver = self.receivers.get(receiver_id)
+			if receiver is None:
+				continue
+			pipes = self._pipes.get(receiver_id)
+			if any_pipe:
+				is_pipe = bool(pipes)
+			else:
+				is_pipe = key != ANY_ID and bool(pipes) and key in pipes
+			rv.append((receiver, isinstance(receiver, WeakTypes), is_pipe,
+						self._modes.get(receiver_id)))
+		return tuple(rv)
+
 	def is_pipe(self, receiver, sender=None, sender_id=None):
 		rid = self.hashable_id(receiver)
 		if rid in self._pipes:
@@ -156,13 +262,29 @@ class Signal(bl.Signal):
 				sender_id = self.get_sender_id(sender) if sender is not None else None
 			return bool(self._pipes[rid]) if sender_id is None else self.hashable_id(sender_id) in self._pipes[rid]
 
+	# Dispatch tables are dropped after the state they're built from changes,
+	# so that a table built from the old state can't outlive the change.
+
 	def _disconnect(self, receiver_id, sender_id):
 		super(Signal, self)._disconnect(receiver_id, sender_id)
+		if sender_id == ANY_ID:
+			self._modes.pop(receiver_id, None)
 		if receiver_id in self._pipes:
 			if sender_id == ANY_ID:
 				self._pipes.pop(receiver_id)
 			else:
-				self._pipes[receiver_id].remove(sender_id)
+				self._pipes[receiver_id].discard(sender_id)
+		self._dispatch = {}
+
+	def _cleanup_sender(self, sender_ref):
+		super(Signal, self)._cleanup_sender(sender_ref)
+		self._dispatch = {}
+
+	def _clear_state(self):
+		self._pipes.clear()
+		self._modes.clear()
+		super(Signal, self)._clear_state()
+		self._dispatch = {}
 
 
 
@@ -179,3 +301,312 @@ class NamedSignal(Signal):
 		base = super(NamedSignal, self).__repr__()
 		return "%s; %r>" % (base[:-1], self.name)
 
+
+
+
+#: Sent when a receiver running in the background (see :meth:`Signal.connect`)
+#: fails. The sender is the signal and the `receiver`, `mode` and
+#: `exception` are passed as kwargs.
+receiver_failed = NamedSignal('signal.receiver_failed')
+
+_DEFERRED_ATTR = '_flex_deferred_receivers'
+
+
+class ReceiverDispatcher(object):
+	"""Runs the receivers connected with a background `mode`.
+
+	Thread receivers run on a pool of `max_workers` threads. At most
+	`max_queue` of them can be waiting; beyond that they are run inline so
+	that a burst of signals can't grow the queue without bound. Thread and
+	async receivers dispatched within an app context run in an app context
+	of the same app. Failures are logged and reported through
+	:data:`receiver_failed`. See :meth:`stats`.
+	"""
+
+	def __init__(self, max_workers=4, max_queue=1000):
+		self.max_workers = max_workers
+		self.max_queue = max_queue
+		self._lock = Lock()
+		self._executor = None
+		self._loop = None
+		self._pid = None
+		self._stats = {m: dict(dispatched=0, pending=0, failed=0) for m in MODES if m and m != 'sync'}
+		self._overflowed = 0
+
+	def configure(self, max_workers=None, max_queue=None):
+		"""Change the pool size or the max queue depth. The pool is resized
+		the next time a thread receiver is dispatched.
+		"""
+		with self._lock:
+			if max_workers is not None and max_workers != self.max_workers:
+				self.max_workers = max_workers
+				executor, self._executor = self._executor, None
+				if executor is not None:
+					executor.shutdown(wait=False)
+			if max_queue is not None:
+				self.max_queue = max_queue
+		return self
+
+	def stats(self):
+		"""Return the number of dispatched, pending (queued or running) and
+		failed receivers per mode and the number of thread receivers run
+		inline because the queue was full.
+		"""
+		with self._lock:
+			rv = {m: dict(s) for m, s in self._stats.items()}
+			rv['overflowed'] = self._overflowed
+		return rv
+
+	def dispatch(self, signal, mode, receiver, sender, kwargs):
+		"""Run receiver in the background according to mode. Returns a
+		:class:`concurrent.futures.Future` for 'thread' and 'async'
+		receivers (an :class:`asyncio.Task` when called from a running
+		loop) and None for 'deferred' ones.
+		"""
+		with self._lock:
+			stats = self._stats[mode]
+			if mode == 'thread' and stats['pending'] >= self.max_queue:
+				self._overflowed += 1
+				overflow = True
+			else:
+				stats['dispatched'] += 1
+				stats['pending'] += 1
+				overflow = False
+
+		if overflow:
+			self._call(signal, mode, receiver, sender, kwargs, count=False)
+			return None
+		elif mode == 'deferred':
+			if not has_app_context():
+				# Nothing to defer the call to.
+				self._call(signal, mode, receiver, sender, kwargs)
+			else:
+				g.setdefault(_DEFERRED_ATTR, []).append((signal, receiver, sender, kwargs))
+			return None
+
+		app = current_app._get_current_object() if has_app_context() else None
+		if mode == 'thread':
+			return self._get_executor().submit(self._call, signal, mode, receiver, sender, kwargs, app=app)
+		else:
+			coro = self._acall(signal, mode, receiver, sender, kwargs, app)
+			try:
+				loop = asyncio.get_running_loop()
+			except RuntimeError:
+				return asyncio.run_coroutine_threadsafe(coro, self._get_loop())
+			return loop.create_task(coro)
+
+	def run_deferred(self):
+		"""Run the deferred receivers of the current app context."""
+		pending = g.pop(_DEFERRED_ATTR, None) if has_app_context() else None
+		for signal, receiver, sender, kwargs in pending or ():
+			self._call(signal, 'deferred', receiver, sender, kwargs)
+
+	def _call(self, signal, mode, receiver, sender, kwargs, count=True, app=None):
+		try:
+			if app is not None:
+				with app.app_context():
+					return self._call(signal, mode, receiver, sender, kwargs, False)
+			elif profiler.enabled:
+				return profiler.call(signal, receiver, sender, kwargs)
+			return receiver(sender, **kwargs)
+		except Exception as e:
+			self._failed(signal, mode, receiver, e)
+		finally:
+			if count:
+				self._done(mode)
+
+	async def _acall(self, signal, mode, receiver, sender, kwargs, app=None):
+		started = time.perf_counter()
+		ctx = None if app is None else app.app_context()
+		try:
+			if ctx is None:
+				rv = receiver(sender, **kwargs)
+			else:
+				ctx.push()
+				try:
+					rv = receiver(sender, **kwargs)
+				finally:
+					# Only taken off the stack (see _in_context). It's
+					# popped and torn down once the receiver is done.
+					_app_ctx_stack.pop()
+			if inspect.isawaitable(rv):
+				rv = await (rv if ctx is None else _in_context(ctx, rv))
+			return rv
+		except Exception as e:
+			self._failed(signal, mode, receiver, e)
+		finally:
+			if ctx is not None:
+				_app_ctx_stack.push(ctx)
+				ctx.pop()
+			self._done(mode)
+			if profiler.enabled:
+				profiler.record(signal, receiver, sender, time.perf_counter() - started)
+
+	def _done(self, mode):
+		with self._lock:
+			self._stats[mode]['pending'] -= 1
+
+	def _failed(self, signal, mode, receiver, exception):
+		with self._lock:
+			self._stats[mode]['failed'] += 1
+		logger.exception('Receiver %r of %r (mode %s) failed: %s' % (receiver, signal, mode, exception))
+		if receiver_failed.receivers and signal is not receiver_failed:
+			try:
+				receiver_failed.send(signal, receiver=receiver, mode=mode, exception=exception)
+			except Exception:
+				logger.exception('Failed to report a receiver failure.')
+
+	def _check_pid(self):
+		# Neither threads nor event loops survive a fork.
+		if self._pid != os.getpid():
+			self._executor = self._loop = None
+			self._pid = os.getpid()
+
+	def _get_executor(self):
+		with self._lock:
+			self._check_pid()
+			if self._executor is None:
+				self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix='signal-receiver')
+			return self._executor
+
+	def _get_loop(self):
+		with self._lock:
+			self._check_pid()
+			if self._loop is None:
+				self._loop = asyncio.new_event_loop()
+				Thread(target=self._loop.run_forever, name='signal-receiver-loop', daemon=True).start()
+			return self._loop
+
+
+@types.coroutine
+def _in_context(ctx, awaitable):
+	"""Await awaitable with the app context ctx on the context stack while
+	each of its steps runs. Context stacks are thread-local and other tasks
+	of the loop run between the steps, so ctx can't stay pushed across them.
+	"""
+	it = awaitable.__await__()
+	send, value = it.send, None
+	while True:
+		_app_ctx_stack.push(ctx)
+		try:
+			yielded = send(value)
+		except StopIteration as e:
+			return e.value
+		finally:
+			_app_ctx_stack.pop()
+		try:
+			value, send = (yield yielded), it.send
+		except BaseException as e:
+			value, send = e, it.throw
+
+
+#: The dispatcher running background receivers.
+dispatcher = ReceiverDispatcher()
+
+
+
+class SignalProfiler(object):
+	"""Records the number of calls and the cumulative and max latency of
+	each receiver of each signal while :attr:`enabled`. Calls slower than
+	`threshold` seconds are logged with their sender.
+
+	Profiling is off by default. It can be switched on and off at any time
+	with :meth:`enable` and :meth:`disable`, or from startup (so that boot
+	signals are recorded too) by setting the FLEX_PROFILE_SIGNALS
+	environment variable to the threshold in milliseconds.
+	"""
+
+	def __init__(self, threshold=0.1):
+		self.enabled = False
+		self.threshold = threshold
+		self._lock = Lock()
+		self._records = {}
+
+	def enable(self, threshold=None):
+		if threshold is not None:
+			self.threshold = threshold
+		self.enabled = True
+		return self
+
+	def disable(self):
+		self.enabled = False
+		return self
+
+	def reset(self):
+		with self._lock:
+			self._records = {}
+
+	def call(self, signal, receiver, sender, kwargs):
+		"""Call receiver and record how long it took."""
+		started = time.perf_counter()
+		try:
+			return receiver(sender, **kwargs)
+		finally:
+			self.record(signal, receiver, sender, time.perf_counter() - started)
+
+	def record(self, signal, receiver, sender, elapsed):
+		# Keyed by name so that receivers aren't kept alive.
+		key = (_label(signal), _label(receiver))
+		with self._lock:
+			rv = self._records.get(key)
+			if rv is None:
+				rv = self._records[key] = [0, 0.0, 0.0]
+			rv[0] += 1
+			rv[1] += elapsed
+			if elapsed > rv[2]:
+				rv[2] = elapsed
+
+		if self.threshold is not None and elapsed >= self.threshold:
+			logger.warning('Slow receiver %s of %s took %.1fms (sender: %r).'
+					% (key[1], key[0], elapsed * 1000, sender))
+
+	def stats(self, by='receiver', sort='total'):
+		"""Return the recorded timings (in seconds) as a list of dicts with
+		the `signal`, `receiver` (unless `by` is 'signal'), `calls`, `total`,
+		`mean` and `max`, sorted by `sort` in descending order.
+		"""
+		with self._lock:
+			records = [(s, r, list(v)) for (s, r), v in self._records.items()]
+
+		rows = {}
+		for signal, receiver, (calls, total, max_) in records:
+			key = (signal,) if by == 'signal' else (signal, receiver)
+			row = rows.get(key)
+			if row is None:
+				rows[key] = [calls, total, max_]
+			else:
+				row[0] += calls
+				row[1] += total
+				row[2] = max(row[2], max_)
+
+		rv = []
+		for key, (calls, total, max_) in rows.items():
+			row = dict(signal=key[0], calls=calls, total=total, mean=total / calls, max=max_)
+			if by != 'signal':
+				row['receiver'] = key[1]
+			rv.append(row)
+		rv.sort(key=lambda r: r[sort], reverse=True)
+		return rv
+
+
+def _label(obj):
+	if isinstance(obj, NamedSignal):
+		return obj.name
+	name = getattr(obj, '__qualname__', None) or getattr(obj, '__name__', None)
+	if name is None:
+		return repr(obj)
+	module = getattr(obj, '__module__', None)
+	return '%s.%s' % (module, name) if module else name
+
+
+#: The profiler of all signals.
+profiler = SignalProfiler()
+
+if os.environ.get('FLEX_PROFILE_SIGNALS'):
+	profiler.enable(float(os.environ['FLEX_PROFILE_SIGNALS']) / 1000)
+
+
+def _run_deferred_receivers(sender, **kwargs):
+	dispatcher.run_deferred()
+
+appcontext_tearing_down.connect(_run_deferred_receivers, weak=False)
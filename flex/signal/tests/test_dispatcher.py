@@ -0,0 +1,56 @@
+import asyncio
+
+from flask import Flask, current_app, g
+
+from flex.signal.signals import Signal, dispatcher
+
+
+def make_app():
+	app = Flask(__name__)
+	app.config['AUDIT_LOG'] = 'audit'
+	return app
+
+
+def test_thread_receiver_runs_in_app_context():
+	signal = Signal()
+
+	def receiver(sender):
+		return current_app.config['AUDIT_LOG']
+
+	signal.connect(receiver, mode='thread')
+	with make_app().app_context():
+		(_, future), = signal.send(None)
+	assert future.result(timeout=5) == 'audit'
+
+
+def test_async_receivers_keep_their_app_context_across_awaits():
+	signal = Signal()
+	apps = [make_app() for _ in range(3)]
+	for i, app in enumerate(apps):
+		app.config['AUDIT_LOG'] = i
+
+	async def receiver(sender):
+		g.value = current_app.config['AUDIT_LOG']
+		await asyncio.sleep(0.01)
+		return g.value, current_app.config['AUDIT_LOG']
+
+	signal.connect(receiver, mode='async')
+	futures = []
+	for app in apps:
+		with app.app_context():
+			(_, future), = signal.send(None)
+			futures.append(future)
+	assert [f.result(timeout=5) for f in futures] == [(i, i) for i in range(3)]
+
+
+def test_background_receivers_without_app_context():
+	signal = Signal()
+
+	def receiver(sender):
+		return 'done'
+
+	signal.connect(receiver, mode='thread')
+	failed = dispatcher.stats()['thread']['failed']
+	(_, future), = signal.send(None)
+	assert future.result(timeout=5) == 'done'
+	assert dispatcher.stats()['thread']['failed'] == failed
@@ -18,6 +18,9 @@ setup(
 	install_requires=[
 		'Werkzeug', 'Blinker'
 	],
+	extras_require={
+		'msgpack': ['msgpack>=1.0'],
+	},
 	classifiers=(
 		"Programming Language :: Python :: 3",
 		"License :: OSI Approved :: MIT License",